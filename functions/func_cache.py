@@ -0,0 +1,249 @@
+import asyncio
+import hashlib
+import os
+import random
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import bot_settings
+from functions import func_logs
+
+CACHE_SETTINGS = getattr(bot_settings, "cache_settings", {})
+LOG = func_logs.get_logger("cache")
+# file io of the byte caches, one thread keeps the writes and deletes of a file in order
+DISK = ThreadPoolExecutor(max_workers=1, thread_name_prefix="byte-cache")
+# everything with a stats method which should show up in the owner stats command
+STATS_SOURCES = []
+
+
+def register_stats(source):
+    STATS_SOURCES.append(source)
+    return source
+
+
+class TTLCache:
+    def __init__(self, name: str, ttl: float, maxsize: int = 0, jitter: float = 0):
+        """In-process cache with a ttl per entry and an optional lru size bound
+        :param name: str
+            name used in the stats output
+        :param ttl: float
+            seconds until an entry expires
+        :param maxsize: int
+            max amount of entries, 0 for unbounded
+        :param jitter: float
+            random share of the ttl added or removed per entry, so entries don't all expire at once
+        """
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.jitter = jitter
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        register_stats(self)
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        if self.jitter:
+            ttl *= 1 + random.uniform(-self.jitter, self.jitter)
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        if self.maxsize and len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0
+        }
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def _write(path: str, value: bytes):
+    # written to a temporary file first, a reader never sees half a file
+    with open(path + ".tmp", "wb") as file:
+        file.write(value)
+    os.replace(path + ".tmp", path)
+
+
+def _remove(paths: list):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class ByteCache:
+    def __init__(self, name: str, max_bytes: int, directory: str = None, max_disk_bytes: int = None):
+        """Lru cache for bytes with a memory budget, evicted entries are written to directory if one is set
+        :param max_bytes: int
+            memory budget of all cached values together
+        :param directory: str
+            optional on disk cache directory
+        :param max_disk_bytes: int
+            budget of the files in directory, the least recently used ones are deleted, 8 times max_bytes if None
+        """
+        self.name = name
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_bytes * 8 if max_disk_bytes is None else max_disk_bytes
+        self.size = 0
+        self.disk_size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        # file name -> size of the files on disk, in the order they were last used
+        self._disk = OrderedDict()
+        self._writing = set()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load_disk()
+        register_stats(self)
+
+    def _load_disk(self):
+        # the files of an earlier run count against the budget, the oldest ones are evicted first
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.is_file()),
+                         key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if entry.name.endswith(".tmp"):
+                _remove([entry.path])
+                continue
+            self._disk[entry.name] = entry.stat().st_size
+            self.disk_size += self._disk[entry.name]
+        _remove(self._evict_disk())
+
+    @staticmethod
+    def _name(key) -> str:
+        return hashlib.sha1(str(key).encode()).hexdigest()
+
+    async def get(self, key):
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+        name = self._name(key) if self.directory else None
+        if name in self._disk:
+            self._disk.move_to_end(name)
+            try:
+                value = await asyncio.get_event_loop().run_in_executor(DISK, _read,
+                                                                       os.path.join(self.directory, name))
+            except OSError:
+                # deleted by hand or evicted while it was read
+                self._forget(name)
+            else:
+                self.disk_hits += 1
+                self._store(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key, value: bytes):
+        self._store(key, value)
+
+    def _store(self, key, value: bytes):
+        if key in self._data:
+            self.size -= len(self._data.pop(key))
+        if len(value) > self.max_bytes:
+            self._spill(key, value)
+            return
+        self._data[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            old_key, old_value = self._data.popitem(last=False)
+            self.size -= len(old_value)
+            self._spill(old_key, old_value)
+
+    def _spill(self, key, value: bytes):
+        if not self.directory:
+            return
+        name = self._name(key)
+        if name in self._disk or name in self._writing or len(value) > self.max_disk_bytes:
+            return
+        self._writing.add(name)
+        future = asyncio.get_event_loop().run_in_executor(DISK, _write, os.path.join(self.directory, name), value)
+        future.add_done_callback(lambda done: self._written(name, len(value), done))
+
+    def _written(self, name: str, size: int, future: asyncio.Future):
+        self._writing.discard(name)
+        if future.cancelled() or future.exception() is not None:
+            LOG.error("ByteCache could not write", cache=self.name,
+                      error=None if future.cancelled() else future.exception())
+            return
+        self._disk[name] = size
+        self.disk_size += size
+        evicted = self._evict_disk()
+        if evicted:
+            asyncio.get_event_loop().run_in_executor(DISK, _remove, evicted)
+
+    def _evict_disk(self) -> list:
+        # _evict_disk: drops the least recently used files from the index and returns their paths
+        paths = []
+        while self.disk_size > self.max_disk_bytes and self._disk:
+            name, size = self._disk.popitem(last=False)
+            self.disk_size -= size
+            paths.append(os.path.join(self.directory, name))
+        return paths
+
+    def _forget(self, name: str):
+        size = self._disk.pop(name, None)
+        if size is not None:
+            self.disk_size -= size
+
+    def stats(self) -> dict:
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            "name": self.name,
+            "entries": len(self._data),
+            "bytes": self.size,
+            "disk_entries": len(self._disk),
+            "disk_bytes": self.disk_size,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.disk_hits) / total, 4) if total else 0.0
+        }
+
+
+# shared per guild server settings, invalidated by the ServerDatabase setters
+SERVER_SETTINGS = TTLCache("server_settings", ttl=CACHE_SETTINGS.get("server_ttl", 300),
+                           maxsize=CACHE_SETTINGS.get("server_maxsize", 10000))
+
+
+def all_stats() -> list:
+    # all_stats: returns the stats of every registered cache or buffer
+    return [source.stats() for source in STATS_SOURCES]
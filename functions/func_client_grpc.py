@@ -1,8 +1,23 @@
+import asyncio
+import hashlib
+import itertools
+import time
+from concurrent.futures.process import BrokenProcessPool
+
 import grpc
 
 from functions.grpc_functions import image_pb2_grpc, image_pb2
+from functions import func_errors, func_cache, func_render, func_metrics
 import bot_settings
 
+GRPC_SETTINGS = bot_settings.grpc_settings
+CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", GRPC_SETTINGS.get("keepalive_ms", 30000)),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
 
 class Role:
     def __init__(self, role_id, role_name):
@@ -10,34 +25,166 @@ class Role:
         self.role_name: str = role_name
 
 
+class ChannelPool:
+    def __init__(self, address: str, size: int = 2):
+        """Long lived channels which are reused for every call, picked round robin"""
+        self.address = address
+        self.size = size
+        self.stubs = []
+        self._cycle = None
+
+    def get_stub(self) -> image_pb2_grpc.GenerateImagesStub:
+        # the channels are created on first use since they need the running event loop
+        if not self.stubs:
+            self.stubs = [image_pb2_grpc.GenerateImagesStub(grpc.aio.insecure_channel(self.address,
+                                                                                      options=CHANNEL_OPTIONS))
+                          for _ in range(self.size)]
+            self._cycle = itertools.cycle(self.stubs)
+        return next(self._cycle)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        """Stops calling the image service after failure_threshold failures in a row for reset_timeout seconds,
+        after that one call is let through to check if the service is back"""
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        # start of the trial call while half open, every other call is rejected until its result is known
+        self.probe_at = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.reset_timeout:
+            return False
+        # half open, a trial which never reported back (cancelled) doesn't keep the breaker open forever
+        if self.probe_at is None or now - self.probe_at >= self.reset_timeout:
+            self.probe_at = now
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probe_at is not None or self.failures >= self.failure_threshold:
+            # a failed trial opens the breaker again for another reset_timeout
+            self.opened_at = time.monotonic()
+            self.probe_at = None
+
+
+POOL = ChannelPool(GRPC_SETTINGS["address"], size=GRPC_SETTINGS.get("channels", 2))
+BREAKER = CircuitBreaker(failure_threshold=GRPC_SETTINGS.get("failure_threshold", 5),
+                         reset_timeout=GRPC_SETTINGS.get("reset_timeout", 30))
+# rendered cards keyed by a hash of everything which is visible on them
+RENDERS = func_cache.ByteCache("rank_cards",
+                               max_bytes=func_cache.CACHE_SETTINGS.get("render_max_bytes", 64 * 1024 ** 2),
+                               directory=func_cache.CACHE_SETTINGS.get("render_directory"),
+                               max_disk_bytes=func_cache.CACHE_SETTINGS.get("render_disk_max_bytes"))
+
+
+def render_key(exp, required_exp, position, user_name, server_name, rank_card, next_role: Role,
+               profile_picture: bytes) -> str:
+    # render_key: the avatar is included as hash of its bytes, so a new avatar creates a new card
+    avatar_hash = hashlib.sha1(profile_picture).hexdigest()
+    fields = (exp, required_exp, position, user_name, server_name, rank_card, next_role.role_id,
+              next_role.role_name, avatar_hash)
+    return hashlib.sha1(repr(fields).encode()).hexdigest()
+
+
 class Generator:
     @staticmethod
     async def get_level_image(exp: int, required_exp: float, position: str, user_name: str,
                               server_name: str, rank_card: str, next_role: Role, profile_picture: bytes) -> bytes:
-        async with grpc.aio.insecure_channel(bot_settings.grpc_settings["address"]) as channel:
-            stub = image_pb2_grpc.GenerateImagesStub(channel)
-            response = await stub.GenerateLevelImage(
-                image_pb2.LevelData(
-                    EXP=exp, RequiredEXP=required_exp, Position=position, UserName=user_name, ServerName=server_name,
-                    RankCard=rank_card, NextRoleName=next_role.role_name, NextRoleId=next_role.role_id,
-                    profile=profile_picture,
-                )
-            )
-        return response.Image
-
-
-# TODO: write tests
-
-async def main():
-    generator = Generator()
-    file = open("D:/Go/src/MicroServices/utils/7ad9babe7fbcd68d886e6e80f7675985.png", "rb") # read the file as bytes
-    data = file.read()
-    file.close()
-    await generator.get_level_image(10, 100, "#12", "Pum", "Test fishy", "default",
-                                    Role(role_name="test", role_id=1231), data)
+        key = render_key(exp, required_exp, position, user_name, server_name, rank_card, next_role, profile_picture)
+        image = await RENDERS.get(key)
+        if image is not None:
+            return image
+        backend = func_render.RENDER_SETTINGS.get("backend", "grpc")
+        start = time.perf_counter()
+        status = "error"
+        try:
+            if backend == "local":
+                try:
+                    image = await func_render.RENDERER.render(exp, required_exp, position, user_name, server_name,
+                                                              rank_card, next_role.role_name, profile_picture)
+                except (OSError, ValueError, BrokenProcessPool) as error:
+                    # a broken picture or a dead worker, the callers fall back like for the grpc service
+                    raise func_errors.ImageServiceUnavailable(f"The local renderer failed: {error}") from error
+            else:
+                image = await Generator.get_grpc_image(exp, required_exp, position, user_name, server_name,
+                                                       rank_card, next_role, profile_picture)
+            status = "ok"
+        except func_errors.ImageServiceUnavailable:
+            # breaker open, deadline exceeded or the service failed, the slow cases
+            status = "unavailable"
+            raise
+        finally:
+            func_metrics.IMAGES.observe(time.perf_counter() - start, backend, status)
+        RENDERS.set(key, image)
+        return image
 
-if __name__ == "__main__":
-    import asyncio
+    @staticmethod
+    async def get_grpc_image(exp: int, required_exp: float, position: str, user_name: str,
+                             server_name: str, rank_card: str, next_role: Role, profile_picture: bytes) -> bytes:
+        if not BREAKER.allow():
+            raise func_errors.ImageServiceUnavailable("The image service is currently unavailable.")
+        request = image_pb2.LevelData(
+            EXP=exp, RequiredEXP=required_exp, Position=position, UserName=user_name, ServerName=server_name,
+            RankCard=rank_card, NextRoleName=next_role.role_name, NextRoleId=next_role.role_id,
+            profile=profile_picture,
+        )
+        retries = GRPC_SETTINGS.get("retries", 2)
+        for attempt in range(retries + 1):
+            try:
+                response = await POOL.get_stub().GenerateLevelImage(request, timeout=GRPC_SETTINGS.get("deadline", 5))
+            except grpc.aio.AioRpcError as error:
+                # only UNAVAILABLE is retried, anything else would most likely fail again
+                if error.code() == grpc.StatusCode.UNAVAILABLE and attempt < retries:
+                    await asyncio.sleep(0.1 * 2 ** attempt)
+                    continue
+                BREAKER.record_failure()
+                raise func_errors.ImageServiceUnavailable(f"The image service failed: {error.code().name}")
+            BREAKER.record_success()
+            return response.Image
 
+
+# benchmark: new channel per call against the channel pool, and how fast calls fail once the service is down
+async def main(iterations: int = 500):
+    from functions.grpc_functions import stub_server
+
+    server, _ = await stub_server.start_server(GRPC_SETTINGS["address"], latency=0.002)
+    request = image_pb2.LevelData(EXP=10, RequiredEXP=100, Position="#12", UserName="Pum", profile=b"\0" * 20000)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        async with grpc.aio.insecure_channel(GRPC_SETTINGS["address"]) as channel:
+            await image_pb2_grpc.GenerateImagesStub(channel).GenerateLevelImage(request)
+    old = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(iterations):
+        await Generator.get_grpc_image(i, 100, "#12", "Pum", "Test", "default", Role(1, "test"), b"\0" * 20000)
+    new = time.perf_counter() - start
+    await server.stop(None)
+    failures = []
+    for _ in range(20):
+        start = time.perf_counter()
+        try:
+            await Generator.get_grpc_image(10, 100, "#12", "Pum", "Test", "default", Role(1, "test"), b"")
+        except func_errors.ImageServiceUnavailable:
+            pass
+        failures.append(time.perf_counter() - start)
+    print(f"Channel per call: {old / iterations * 1000:.2f} ms per card\n"
+          f"Channel pool:     {new / iterations * 1000:.2f} ms per card\n"
+          f"Service down:     {failures[0] * 1000:.1f} ms for the first call, "
+          f"{failures[-1] * 1000:.3f} ms once the breaker is open")
+
+
+if __name__ == "__main__":
     loop = asyncio.get_event_loop()
     loop.run_until_complete(main())
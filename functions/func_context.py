@@ -1,7 +1,7 @@
 import discord
 from discord.ext import commands
 
-from functions import func_database
+from functions import func_database, func_loader
 
 import bot_settings
 
@@ -15,25 +15,25 @@ class FullContext(commands.Context):
         self.server_information = None
         self.global_information = None
         self.local_information = None
+        # shared with the prefix resolution of the same message
+        self.loader = func_loader.current() or func_loader.RequestLoader()
 
     async def get_user_information(self) -> tuple:
         """
         :return: tuple
             Global, Local
         """
-        if not self.global_information or not self.local_information:
-            global_information = await udb.get_user_information_global(self.author.id).to_list(length=1)
-            self.global_information = global_information[0] if global_information else {}
-            local_information = await udb.get_user_information(self.author.id, self.guild.id).to_list(length=1)
-            self.local_information = local_information[0] if local_information else {}
-
+        if self.global_information is None or self.local_information is None:
+            self.global_information, self.local_information = await self.loader.get_user(self.author.id,
+                                                                                         self.guild.id)
         return self.global_information, self.local_information
 
-    async def set_user_information(self, query, global_=True):
+    async def set_user_information(self, query, global_=True, projection: dict = None):
         if global_:
-            return await udb.set_setting_global(self.author.id, query=query)
+            return await udb.set_setting_global(self.author.id, query=query, projection=projection)
         else:
-            return await udb.set_setting_local(self.author.id, server_id=self.guild.id, query=query)
+            return await udb.set_setting_local(self.author.id, server_id=self.guild.id, query=query,
+                                               projection=projection)
 
     async def get_embed_color(self) -> discord.Color:
         information = await self.get_user_information()
@@ -44,9 +44,8 @@ class FullContext(commands.Context):
         return discord.Color(embed_color)
 
     async def get_server_information(self):
-        if not self.server_information:
-            server_information = await sdb.get_server_information(self.guild.id).to_list(length=1)
-            self.server_information = server_information[0] if server_information else {}
+        if self.server_information is None:
+            self.server_information = await self.loader.get_server(self.guild.id)
         return self.server_information
 
     async def set_server_information(self, query):
@@ -0,0 +1,204 @@
+import sys
+import time
+
+import aioredis
+
+import bot_settings
+from functions import func_cache, func_redis
+
+COOLDOWN_SETTINGS = getattr(bot_settings, "cooldown_settings", {})
+MEMORY_COOLDOWNS = None
+
+# arms every cooldown which is not running yet and returns 1 for every reward which is due
+# KEYS: the cooldown keys, ARGV: the cooldown in seconds for each key, 0 skips the key
+COOLDOWN_SCRIPT = """
+local result = {}
+for i, key in ipairs(KEYS) do
+    local cooldown = tonumber(ARGV[i])
+    if cooldown > 0 and redis.call('SET', key, 1, 'EX', cooldown, 'NX') then
+        result[i] = 1
+    else
+        result[i] = 0
+    end
+end
+return result
+"""
+
+
+def cooldown_key(user_id: int, server_id: int, reward: str) -> str:
+    # cooldown_key: same key format as the old GET/SET handlers so running cooldowns survive the switch
+    return f"{user_id} - {server_id}{reward}"
+
+
+class RedisCooldowns:
+    def __init__(self, cache=None):
+        """Checks and arms message reward cooldowns with a single atomic script call
+        :param cache: aioredis.Redis
+            the redis pool the cooldown keys are stored in, the shared cooldowns pool if None
+        """
+        self._cache = cache
+        self.sha = None
+
+    @property
+    def cache(self) -> aioredis.Redis:
+        # resolved on every use since the manager replaces broken pools
+        return self._cache or func_redis.MANAGER.get("cooldowns")
+
+    async def load_script(self):
+        self.sha = await self.cache.script_load(COOLDOWN_SCRIPT)
+        return self.sha
+
+    async def acquire(self, user_id: int, server_id: int, cooldowns: dict) -> dict:
+        """Arms the cooldowns which are not running yet
+        :param cooldowns: dict
+            reward name -> cooldown in seconds, 0 or None if the reward should be skipped
+        :return: dict
+            reward name -> True if the reward is due
+        """
+        rewards = list(cooldowns.keys())
+        keys = [cooldown_key(user_id, server_id, reward) for reward in rewards]
+        args = [int(cooldowns[reward] or 0) for reward in rewards]
+        if not any(args):
+            return {reward: False for reward in rewards}
+        if not self.sha:
+            await self.load_script()
+        try:
+            result = await self.cache.evalsha(self.sha, keys=keys, args=args)
+        except aioredis.errors.ReplyError as error:
+            # the script cache gets cleared when redis restarts
+            if not str(error).startswith("NOSCRIPT"):
+                raise
+            await self.load_script()
+            result = await self.cache.evalsha(self.sha, keys=keys, args=args)
+        return {reward: bool(due) for reward, due in zip(rewards, result)}
+
+
+class MemoryCooldowns:
+    def __init__(self, wheel_size: int = 4096, resolution: float = 1.0):
+        """Hashed timer wheel which keeps the cooldowns in process, only usable if the bot runs in a single process
+        :param wheel_size: int
+            amount of slots, cooldowns longer than wheel_size * resolution take more than one turn
+        :param resolution: float
+            seconds per slot
+        """
+        self.wheel_size = wheel_size
+        self.resolution = resolution
+        self.slots = [set() for _ in range(wheel_size)]
+        # compact key -> tick at which the cooldown runs out
+        self.expires = {}
+        self.rewards = {}
+        self.current_tick = self._now()
+        func_cache.register_stats(self)
+
+    def _now(self) -> int:
+        return int(time.monotonic() / self.resolution)
+
+    def _key(self, user_id: int, server_id: int, reward: str) -> int:
+        # _key: packs the ids and the reward index into one int instead of a string per cooldown
+        index = self.rewards.setdefault(reward, len(self.rewards))
+        return (((user_id << 64) | server_id) << 4) | index
+
+    def _advance(self, now: int):
+        # _advance: expires every slot between the last tick and now, each slot is only visited once per turn
+        steps = min(now - self.current_tick, self.wheel_size)
+        for tick in range(now - steps + 1, now + 1):
+            slot = self.slots[tick % self.wheel_size]
+            if not slot:
+                continue
+            for key in [key for key in slot if self.expires.get(key, 0) <= now]:
+                slot.discard(key)
+                self.expires.pop(key, None)
+        self.current_tick = now
+
+    async def acquire(self, user_id: int, server_id: int, cooldowns: dict) -> dict:
+        now = self._now()
+        if now != self.current_tick:
+            self._advance(now)
+        result = {}
+        for reward, cooldown in cooldowns.items():
+            if not cooldown:
+                result[reward] = False
+                continue
+            key = self._key(user_id, server_id, reward)
+            if self.expires.get(key, 0) > now:
+                result[reward] = False
+                continue
+            expires = now + max(int(cooldown / self.resolution), 1)
+            self.expires[key] = expires
+            self.slots[expires % self.wheel_size].add(key)
+            result[reward] = True
+        return result
+
+    def memory_usage(self) -> dict:
+        # memory_usage: approximate size of the containers and keys in bytes
+        sample = next(iter(self.expires), 0)
+        key_size = sys.getsizeof(sample) + sys.getsizeof(self.current_tick)
+        containers = sys.getsizeof(self.expires) + sys.getsizeof(self.slots) + \
+            sum(sys.getsizeof(slot) for slot in self.slots)
+        total = containers + key_size * len(self.expires)
+        return {
+            "entries": len(self.expires),
+            "bytes": total,
+            "bytes_per_entry": round(total / len(self.expires), 1) if self.expires else 0
+        }
+
+    def stats(self) -> dict:
+        return {"name": "memory_cooldowns", **self.memory_usage()}
+
+
+def create_backend():
+    # create_backend: returns the cooldown backend selected in the cooldown settings
+    global MEMORY_COOLDOWNS
+    if COOLDOWN_SETTINGS.get("backend", "redis") == "memory":
+        if not MEMORY_COOLDOWNS:
+            MEMORY_COOLDOWNS = MemoryCooldowns(wheel_size=COOLDOWN_SETTINGS.get("wheel_size", 4096))
+        return MEMORY_COOLDOWNS
+    return RedisCooldowns()
+
+
+def memory_report(entries: int = 1000000):
+    # memory_report: fills a wheel with cooldowns to size the memory backend for large servers
+    import asyncio
+
+    cooldowns = MemoryCooldowns()
+    loop = asyncio.new_event_loop()
+    for i in range(entries):
+        loop.run_until_complete(cooldowns.acquire(100000000000000000 + i, 300000000000000000 + i % 50, {"exp": 60}))
+    loop.close()
+    usage = cooldowns.memory_usage()
+    print(f"{usage['entries']} cooldowns: {usage['bytes'] / 1024 ** 2:.1f} MiB, "
+          f"{usage['bytes_per_entry']} bytes per cooldown")
+
+
+# benchmark: old GET + SET key pattern against the script
+async def main(iterations: int = 10000):
+    cache = await aioredis.create_redis_pool(bot_settings.redis_settings["url"], db=15)
+    cooldowns = RedisCooldowns(cache)
+    await cache.flushdb()
+    start = time.perf_counter()
+    for i in range(iterations):
+        if not await cache.get(f"{i} - 1exp"):
+            await cache.set(f"{i} - 1exp", 1, expire=60)
+        if not await cache.get(f"{i} - 1income"):
+            await cache.set(f"{i} - 1income", 1, expire=60)
+    old = time.perf_counter() - start
+    await cache.flushdb()
+    start = time.perf_counter()
+    for i in range(iterations):
+        await cooldowns.acquire(i, 1, {"exp": 60, "income": 60})
+    new = time.perf_counter() - start
+    await cache.flushdb()
+    cache.close()
+    await cache.wait_closed()
+    print(f"GET/SET pattern: {old / iterations * 1e6:.1f} us per message\n"
+          f"Lua script:      {new / iterations * 1e6:.1f} us per message")
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    if sys.argv[-1] == "memory":
+        memory_report()
+    else:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(main())
@@ -1,16 +1,33 @@
+import asyncio
 import datetime
-import logging
 
 import motor.motor_asyncio
-from pymongo import ReturnDocument, ASCENDING, DESCENDING
+from pymongo import ReturnDocument, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
 
 import bot_settings
+from functions import func_cache, func_logs, func_metrics
 
 DEFAULTS = (bot_settings.database_password[1], bot_settings.database_username[1], bot_settings.database_default)
 
 UDB = None
+BUFFER = None
+BUFFER_SETTINGS = getattr(bot_settings, "write_buffer_settings", {})
 
-LOG = logging.Logger("database", logging.ERROR)
+LOG = func_logs.get_logger("database")
+
+
+# filters and sorts of the rank queries, func_indexes checks the query plans of exactly these
+def rank_filter(server_id: int, setting: str, amount: int) -> dict:
+    return {"server_id": server_id, setting: {"$gt": amount}}
+
+
+def members_filter(server_id: int) -> dict:
+    return {"server_id": server_id}
+
+
+def leaderboard_sort(setting: str) -> list:
+    return [(setting, DESCENDING)]
 
 
 class Database:
@@ -23,56 +40,214 @@ class Database:
         self.db = self.client[dbname]
 
 
+class IncrementBuffer:
+    def __init__(self, collection, interval: float = 5, max_size: int = 1000):
+        """Write behind buffer which merges $inc queries per member and flushes them with one bulk write
+        :param collection: the motor collection the increments are written to
+        :param interval: float
+            seconds between flushes
+        :param max_size: int
+            amount of buffered members which triggers an early flush
+        """
+        self.collection = collection
+        self.interval = interval
+        self.max_size = max_size
+        self.pending = {}
+        # the increments of the bulk write which is running, they are neither pending nor in the database yet
+        self.in_flight = {}
+        # last known persisted values, only kept for fields which are read through get_total
+        self.totals = func_cache.TTLCache("buffered_totals", ttl=BUFFER_SETTINGS.get("totals_ttl", 600),
+                                          maxsize=BUFFER_SETTINGS.get("totals_maxsize", 50000))
+        self.lock = asyncio.Lock()
+        self.task = None
+        self.flushed_operations = 0
+        self.merged_increments = 0
+        func_cache.register_stats(self)
+
+    def start(self):
+        # start: starts the flush loop, calling it more than once does nothing
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._flush_loop())
+
+    def stop(self):
+        # stop: ends the flush loop, a flush which is running is finished and the final flush waits for it
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            # shielded so stopping the loop doesn't cancel a bulk write halfway
+            await asyncio.shield(self.flush())
+
+    def increment(self, user_id: int, server_id: int, query: dict):
+        # increment: adds the values of an $inc query to the pending increments of the member
+        deltas = self.pending.setdefault((user_id, server_id), {})
+        for field, amount in query.items():
+            deltas[field] = deltas.get(field, 0) + amount
+        self.merged_increments += 1
+        if len(self.pending) >= self.max_size and not self.lock.locked():
+            asyncio.ensure_future(self.flush())
+
+    async def get_total(self, user_id: int, server_id: int, field: str) -> int:
+        # get_total: returns the persisted value plus the in flight and pending increments without waiting for a flush
+        key = (user_id, server_id, field)
+        total = self.totals.get(key)
+        if total is None:
+            # read between two flushes, during one the document may or may not contain the in flight increments
+            async with self.lock:
+                document = await self.collection.find_one({"user_id": user_id, "server_id": server_id},
+                                                          projection={field: True, "_id": False})
+            total = (document or {}).get(field, 0)
+            self.totals.set(key, total)
+        return (total + self.in_flight.get((user_id, server_id), {}).get(field, 0)
+                + self.pending.get((user_id, server_id), {}).get(field, 0))
+
+    def set_total(self, user_id: int, server_id: int, field: str, total: int):
+        # set_total: used after a direct write so the running total does not go stale
+        if (user_id, server_id) in self.in_flight:
+            # it is unknown if the direct write saw the in flight increments, the next get_total reads it again
+            self.totals.invalidate((user_id, server_id, field))
+        else:
+            self.totals.set((user_id, server_id, field), total)
+
+    async def write(self, user_id: int, server_id: int, field: str, write):
+        # write: runs a direct write between two flushes, the returned field contains the pending increments
+        async with self.lock:
+            document = await write()
+            if document is not None and field in document:
+                self.totals.set((user_id, server_id, field), document[field])
+                document[field] += self.pending.get((user_id, server_id), {}).get(field, 0)
+        return document
+
+    async def flush(self):
+        async with self.lock:
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, {}
+            self.in_flight = pending
+            keys = list(pending)
+            operations = [
+                UpdateOne({"user_id": user_id, "server_id": server_id}, {"$inc": pending[(user_id, server_id)]},
+                          upsert=True)
+                for user_id, server_id in keys
+            ]
+            failed = set()
+            try:
+                await self.collection.bulk_write(operations, ordered=False)
+            except BulkWriteError as error:
+                # the bulk write is unordered, every operation which isn't listed as failed was applied
+                failed = {keys[write_error["index"]] for write_error in error.details.get("writeErrors", [])}
+                LOG.error("IncrementBuffer.flush partially failed", operations=len(operations), failed=len(failed),
+                          error=error.details.get("writeErrors", [])[:1])
+            except PyMongoError as error:
+                # no write was acknowledged, the whole batch is written again with the next flush
+                failed = set(keys)
+                LOG.error("IncrementBuffer.flush failed", operations=len(operations), error=error)
+            for key in failed:
+                # put the increments back so they get written with the next flush
+                current = self.pending.setdefault(key, {})
+                for field, amount in pending[key].items():
+                    current[field] = current.get(field, 0) + amount
+            self.flushed_operations += len(operations) - len(failed)
+            for (user_id, server_id), deltas in pending.items():
+                if (user_id, server_id) in failed:
+                    continue
+                for field, amount in deltas.items():
+                    total = self.totals.get((user_id, server_id, field))
+                    if total is not None:
+                        self.totals.set((user_id, server_id, field), total + amount)
+            self.in_flight = {}
+
+    def stats(self) -> dict:
+        return {
+            "name": "increment_buffer",
+            "pending": len(self.pending),
+            "merged_increments": self.merged_increments,
+            "flushed_operations": self.flushed_operations
+        }
+
+
+@func_metrics.timed_methods(func_metrics.DATABASE)
 class UserDatabase(Database):
     def __init__(self):
+        global BUFFER
         super(UserDatabase, self).__init__()
         self.local_db = self.db.MemberServerInformation
         self.collection = self.db.User
-
-    def get_user_information(self, user_id: int, server_id: int):
-        LOG.debug(f"UserDatabase.get_user_information user_id: {user_id}, server_id: {server_id}")
-        information = self.local_db.find({"user_id": user_id, "server_id": server_id})
+        if not BUFFER:
+            BUFFER = IncrementBuffer(self.local_db, interval=BUFFER_SETTINGS.get("interval", 5),
+                                     max_size=BUFFER_SETTINGS.get("max_size", 1000))
+        self.increment_buffer = BUFFER
+
+    def get_user_information(self, user_id: int, server_id: int, projection: dict = None):
+        # projection: only the fields the caller needs, the items array can get large
+        LOG.debug("UserDatabase.get_user_information", user_id=user_id, server_id=server_id, projection=projection)
+        information = self.local_db.find({"user_id": user_id, "server_id": server_id}, projection=projection)
         return information
 
     def get_user_information_global(self, user_id: int):
-        LOG.debug(f"UserDatabase.get_user_information_global user_id: {user_id}")
+        LOG.debug("UserDatabase.get_user_information_global", user_id=user_id)
         information = self.collection.find({"user_id": user_id})
         return information
 
-    async def set_setting_global(self, user_id: int, query: dict):
-        LOG.debug(f"UserDatabase.set_setting_global user_id: {user_id}, query: {query}")
+    async def set_setting_global(self, user_id: int, query: dict, projection: dict = None):
+        LOG.debug("UserDatabase.set_setting_global", user_id=user_id, query=query)
         return await self.collection.find_one_and_update(
             {"user_id": user_id},
             query,
+            projection=projection,
             upsert=True,
             return_document=ReturnDocument.AFTER
         )
 
-    async def set_setting_local(self, user_id: int, server_id: int, query: dict):
-        LOG.debug(f"UserDatabase.set_setting_local user_id: {user_id}, server_id: {server_id}, "
-                  f"query: {query}")
+    async def set_setting_local(self, user_id: int, server_id: int, query: dict, projection: dict = None):
+        LOG.debug("UserDatabase.set_setting_local", user_id=user_id, server_id=server_id, query=query)
         return await self.local_db.find_one_and_update(
             {"user_id": user_id, "server_id": server_id},
             query,
+            projection=projection,
             upsert=True,
             return_document=ReturnDocument.AFTER
         )
 
-    async def edit_money(self, user_id: int, server_id: int, amount: int):
-        LOG.debug(f"UserDatabase.edit_money user_id: {user_id}, server_id: {server_id}, amount: {amount}")
-        return await self.set_setting_local(
+    async def edit_money(self, user_id: int, server_id: int, amount: int, projection: dict = None):
+        # the returned document only contains the balance unless another projection is given, the buffered income
+        # is included in it
+        LOG.debug("UserDatabase.edit_money", user_id=user_id, server_id=server_id, amount=amount)
+        return await self.increment_buffer.write(user_id, server_id, "balance", lambda: self.set_setting_local(
             user_id=user_id,
             server_id=server_id,
-            query={"$inc": {"balance": int(amount)}}
-        )
+            query={"$inc": {"balance": int(amount)}},
+            projection=projection or {"_id": False, "balance": True}
+        ))
+
+    def buffer_increment(self, user_id: int, server_id: int, query: dict):
+        # buffer_increment: $inc which is written with the next bulk flush of the increment buffer
+        self.increment_buffer.increment(user_id, server_id, query)
+
+    async def get_buffered_amount(self, user_id: int, server_id: int, setting: str) -> int:
+        return await self.increment_buffer.get_total(user_id, server_id, setting)
+
+    async def flush_increments(self):
+        LOG.debug("UserDatabase.flush_increments")
+        await self.increment_buffer.flush()
+
+    async def close(self):
+        # close: the final flush, called once no more messages are handled
+        LOG.debug("UserDatabase.close")
+        self.increment_buffer.stop()
+        await self.increment_buffer.flush()
 
     async def claim_daily(self, author_user_id: int, user_id: int, server_id: int, amount: int):
-        LOG.debug(f"UserDatabase.claim_daily author_user_id: {author_user_id}, user_id: {user_id}, "
-                  f"server_id: {server_id}, amount: {amount}")
+        LOG.debug("UserDatabase.claim_daily", author_user_id=author_user_id, user_id=user_id, server_id=server_id,
+                  amount=amount)
         await self.set_setting_local(
             user_id=author_user_id,
             server_id=server_id,
-            query={"$set": {"claimed_daily": datetime.datetime.utcnow()}}
+            query={"$set": {"claimed_daily": datetime.datetime.utcnow()}},
+            projection={"_id": True}
         )
         return await self.edit_money(
             user_id=user_id,
@@ -80,23 +255,35 @@ class UserDatabase(Database):
             amount=amount
         )
 
-    async def user_sort_exp(self, server_id: int, setting: str, user_amount: int):
-        LOG.debug(f"UserDatabase.user_sort_exp server_id: {server_id}, setting: {setting}, user_amount: {user_amount}")
-        result = self.local_db.find({
-            "server_id": server_id,
-            setting: {"$gte": user_amount}
-        }).sort(setting, ASCENDING).hint([("exp_amount", ASCENDING)])
+    async def user_rank(self, server_id: int, setting: str, user_amount: int) -> int:
+        # user_rank: counts the members with more points instead of loading them, for exp_amount this is a
+        # COUNT_SCAN on the server_exp index of func_indexes, other settings have no index and are counted with a
+        # collection scan
+        LOG.debug("UserDatabase.user_rank", server_id=server_id, setting=setting, user_amount=user_amount)
+        higher = await self.local_db.count_documents(rank_filter(server_id, setting, user_amount))
+        return higher + 1
+
+    async def user_sort_exp_leaderboard(self, server_id: int, setting: str, offset: int = 0, limit: int = 10):
+        LOG.debug("UserDatabase.user_sort_exp_leaderboard", server_id=server_id, setting=setting, offset=offset,
+                  limit=limit)
+        result = self.local_db.find(
+            members_filter(server_id),
+            projection={"_id": False, "user_id": True, setting: True}
+        ).sort(leaderboard_sort(setting)).skip(offset).limit(limit)
         return await result.to_list(None)
 
-    async def user_sort_exp_leaderboard(self, server_id: int, setting: str):
-        LOG.debug(f"UserDatabase.user_sort_exp_leaderboard server_id: {server_id}, setting: {setting}")
-        result = self.local_db.find({
-            "server_id": server_id
-        }).sort(setting, DESCENDING).hint([("exp_amount", ASCENDING)])
-        return await result.to_list(None)
+    def stream_setting(self, server_id: int, setting: str, batch_size: int = 1000):
+        # stream_setting: cursor over user_id and one setting of every member, used to rebuild mirrors
+        LOG.debug("UserDatabase.stream_setting", server_id=server_id, setting=setting)
+        return self.local_db.find(
+            members_filter(server_id),
+            projection={"_id": False, "user_id": True, setting: True},
+            batch_size=batch_size
+        )
 
-    async def user_add_item(self, user_id: int, server_id: int, item: dict):
-        LOG.debug(f"UserDatabase.user_add_item user_id: {user_id}, server_id: {server_id}, item: {item}")
+    async def user_add_item(self, user_id: int, server_id: int, item: dict, projection: dict = None):
+        # the returned document only contains the _id unless another projection is given, the items array can get large
+        LOG.debug("UserDatabase.user_add_item", user_id=user_id, server_id=server_id, item=item)
         return await self.set_setting_local(
             user_id=user_id,
             server_id=server_id,
@@ -105,65 +292,81 @@ class UserDatabase(Database):
                 "name": item["name"],
                 "usage": 0,
                 "amount": 1
-            }}}
+            }}},
+            projection=projection or {"_id": True}
         )
 
-    async def user_change_usage_amount_item(self, user_id: int, server_id: int, item_id: str, usage: int, amount: int):
-        LOG.debug(f"UserDatabase.user_change_usage_amount_item user_id: {user_id}, server_id: {server_id}, "
-                  f"item_id: {item_id}, usage {usage}, amount: {amount}")
+    async def user_change_usage_amount_item(self, user_id: int, server_id: int, item_id: str, usage: int, amount: int,
+                                            projection: dict = None):
+        LOG.debug("UserDatabase.user_change_usage_amount_item", user_id=user_id, server_id=server_id, item_id=item_id,
+                  usage=usage, amount=amount)
         result = await self.local_db.find_one_and_update(
             {"user_id": user_id, "server_id": server_id},
             {"$inc": {"items.$[item].usage": usage, "items.$[item].amount": amount}},
             array_filters=[{"item.item_id": item_id}],
+            projection=projection or {"_id": True},
             upsert=True,
             return_document=ReturnDocument.AFTER
         )
         return result
 
-    async def remove_item(self, user_id: int, server_id: int, item_id: str):
-        LOG.debug(f"UserDatabase.remove_item user_id: {user_id}, server_id: {server_id}, item_id: {item_id}")
+    async def remove_item(self, user_id: int, server_id: int, item_id: str, projection: dict = None):
+        LOG.debug("UserDatabase.remove_item", user_id=user_id, server_id=server_id, item_id=item_id)
         return await self.set_setting_local(
             user_id=user_id,
             server_id=server_id,
-            query={"$pull": {"items": {"item_id": item_id}}}
+            query={"$pull": {"items": {"item_id": item_id}}},
+            projection=projection or {"_id": True}
         )
 
     async def get_item(self, user_id: int, server_id: int, item_id: str):
-        LOG.debug(f"UserDatabase.get_item user_id: {user_id}, server_id: {server_id}, item_id: {item_id}")
+        LOG.debug("UserDatabase.get_item", user_id=user_id, server_id=server_id, item_id=item_id)
         result = await self.local_db.find_one(
             {"user_id": user_id, "server_id": server_id, "items": {"$elemMatch": {"item_id": item_id}}}
         )
         return result
 
     async def search_items(self, user_id: int, server_id: int, search: str):
-        LOG.debug(f"UserDatabase.search_items user_id: {user_id}, server_id: {server_id}, search: {search}")
+        LOG.debug("UserDatabase.search_items", user_id=user_id, server_id=server_id, search=search)
         result = self.local_db.find(
             {"user_id": user_id, "server_id": server_id, "$text": {"$search": search}}
         )
         return result
 
 
+@func_metrics.timed_methods(func_metrics.DATABASE)
 class ServerDatabase(Database):
     def __init__(self):
         super(ServerDatabase, self).__init__()
         self.collection = self.db.Server
 
     def get_server_information(self, server_id: int):
-        LOG.debug(f"ServerDatabase.get_server_information server_id: {server_id}")
+        LOG.debug("ServerDatabase.get_server_information", server_id=server_id)
         information = self.collection.find({"server_id": server_id})
         return information
 
+    async def get_server_settings(self, server_id: int) -> dict:
+        # get_server_settings: cached version of get_server_information, returns a copy which can be edited
+        information = func_cache.SERVER_SETTINGS.get(server_id)
+        if information is None:
+            LOG.debug("ServerDatabase.get_server_settings cache miss", server_id=server_id)
+            information = await self.collection.find_one({"server_id": server_id}) or {}
+            func_cache.SERVER_SETTINGS.set(server_id, information)
+        return dict(information)
+
     async def set_setting(self, server_id: int, query: dict):
-        LOG.debug(f"ServerDatabase.set_setting server_id: {server_id}, query: {query}")
-        return await self.collection.find_one_and_update(
+        LOG.debug("ServerDatabase.set_setting", server_id=server_id, query=query)
+        result = await self.collection.find_one_and_update(
             {"server_id": server_id},
             query,
             upsert=True,
             return_document=ReturnDocument.AFTER
         )
+        func_cache.SERVER_SETTINGS.set(server_id, result or {})
+        return result
 
     async def edit_prefix(self, server_id: int, prefix: str, action: bool):
-        LOG.debug(f"ServerDatabase.edit_prefix server_id: {server_id} prefix: {prefix} action: {action}")
+        LOG.debug("ServerDatabase.edit_prefix", server_id=server_id, prefix=prefix, action=action)
         query = "$addToSet" if action else "$pull"
         return await self.set_setting(
             server_id=server_id,
@@ -172,17 +375,19 @@ class ServerDatabase(Database):
 
     async def edit_role_settings(self, server_id: int, action: str, setting: str, role_id: int,
                                  third_value: int = None, third_value_settings: str = None):
-        LOG.debug(f"ServerDatabase.edit_prefix server_id: {server_id}, action: {action}, setting: {setting},"
-                  f"role_id: {role_id}, third_value: {third_value}, third_value_settings: {third_value_settings}")
+        LOG.debug("ServerDatabase.edit_role_settings", server_id=server_id, action=action, setting=setting,
+                  role_id=role_id, third_value=third_value, third_value_settings=third_value_settings)
         query = "$addToSet" if action == "add" else "$pull"
         if action == "edit":
             # Needed for an update since it requires more things to be true
-            return await self.collection.find_one_and_update(
+            result = await self.collection.find_one_and_update(
                 {"server_id": server_id, f"{setting}.role_id": role_id},
                 {"$set": {f"{setting}.$.{third_value_settings}": third_value}},
                 upsert=True,
                 return_document=ReturnDocument.AFTER,
             )
+            func_cache.SERVER_SETTINGS.invalidate(server_id)
+            return result
         return await self.set_setting(
             server_id=server_id,
             query={query: {setting: {"role_id": role_id,
@@ -190,53 +395,54 @@ class ServerDatabase(Database):
         )
 
 
+@func_metrics.timed_methods(func_metrics.DATABASE)
 class ItemDatabase(Database):
     def __init__(self):
         super(ItemDatabase, self).__init__()
         self.item_db = self.db.ServerItems
 
     async def get_items(self, server_id: int):
-        LOG.debug(f"ItemDatabase.get_items server_id: {server_id}")
+        LOG.debug("ItemDatabase.get_items", server_id=server_id)
         return self.item_db.find(
             {"server_id": server_id},
             projection={"_id": False}
         )
 
     async def get_shop_items(self, server_id: int):
-        LOG.debug(f"ItemDatabase.get_shop_items server_id: {server_id}")
+        LOG.debug("ItemDatabase.get_shop_items", server_id=server_id)
         return self.item_db.find(
             {"server_id": server_id, "available": "true"}
         )
 
     async def search_items(self, server_id: int, search: str):
-        LOG.debug(f"ItemDatabase.search_items server_id: {server_id}, search: {search}")
+        LOG.debug("ItemDatabase.search_items", server_id=server_id, search=search)
         return self.item_db.find(
             {"server_id": server_id, "$text": {"$search": search}},
             projection={"_id": False}
         )
 
     async def search_shop_items(self, server_id: int, search: str):
-        LOG.debug(f"Items.search_shop_items server_id: {server_id}, search: {search}")
+        LOG.debug("Items.search_shop_items", server_id=server_id, search=search)
         return self.item_db.find(
             {"server_id": server_id, "$text": {"$search": search}, "available": "true"},
             projection={"_id": False}
         )
 
     async def get_item(self, server_id: int, item_id: str):
-        LOG.debug(f"ItemDatabase.get_item server_id: {server_id}, item_id: {item_id}")
+        LOG.debug("ItemDatabase.get_item", server_id=server_id, item_id=item_id)
         return await self.item_db.find_one(
             filter={"server_id": server_id, "item_id": item_id}
         )
 
     async def create_item(self, item: dict):
-        LOG.debug(f"ItemDatabase.create_item item: {item}")
+        LOG.debug("ItemDatabase.create_item", item=item)
         result = await self.item_db.insert_one(
             item
         )
         return result
 
     async def edit_item(self, server_id: int, item_id: str, item: dict):
-        LOG.debug(f"ItemDatabase.edit server_id: {server_id}, item_id: {item_id}, item: {item}")
+        LOG.debug("ItemDatabase.edit", server_id=server_id, item_id=item_id, item=item)
         result = await self.item_db.find_one_and_update(
             {"server_id": server_id, "item_id": item_id},
             {"$set": item},
@@ -246,14 +452,14 @@ class ItemDatabase(Database):
         return result
 
     async def delete_item(self, server_id: int, item_id: str):
-        LOG.debug(f"ItemDatabase.delete_item server_id: {server_id}, item_id: {item_id}")
+        LOG.debug("ItemDatabase.delete_item", server_id=server_id, item_id=item_id)
         result = await self.item_db.delete_one(
             {"server_id": server_id, "item_id": item_id}
         )
         return result
 
     async def remove_stock(self, server_id: int, item_id: str):
-        LOG.debug(f"ItemDatabase.remove_stock server_id: {server_id}, item_id: {item_id}")
+        LOG.debug("ItemDatabase.remove_stock", server_id=server_id, item_id=item_id)
         result = await self.item_db.find_one_and_update(
             {"server_id": server_id, "item_id": item_id},
             {"$inc": {"store.stock": -1}},
@@ -266,12 +472,11 @@ class ItemDatabase(Database):
 # test
 async def main():
     db = UserDatabase()
-    res = await db.user_sort_exp(server_id=330300161895038987, setting="exp_amount", user_amount=0)
+    res = await db.user_rank(server_id=330300161895038987, setting="exp_amount", user_amount=0)
     print(res)
 
 
 if __name__ == '__main__':
-    import asyncio
     import bot_settings
 
     loop = asyncio.get_event_loop()
@@ -1,3 +1,6 @@
+import random
+from array import array
+
 from discord.ext import commands
 
 from functions import func_database, func_errors
@@ -21,50 +24,108 @@ class LocalBalance(commands.Converter):
             raise commands.BadArgument()
         if argument < 1:
             raise func_errors.EconomyError("You can't use a negative amount of currency for this action!")
-        information = await ctx.get_user_information()
-        balance: int = information[1].get("balance", 0) if information else 0  # gets the local balance
+        # only the local balance is loaded, together with the income which is still in the write buffer
+        balance: int = await udb.get_buffered_amount(ctx.author.id, ctx.guild.id, "balance")
         if argument > balance:
             raise func_errors.EconomyError(f"You only have {balance}{bs.currency_name}!")
         else:
             return argument, balance
 
 
-class Card:
-    def __init__(self, rank, suit):
-        self.rank = rank
-        self.suit = suit
-        self.cardName = {1: 'Ace', 2: 'Two', 3: 'Three', 4: 'Four', 5: 'Five', 6: 'Six', 7: 'Seven', 8: 'Eight',
-                         9: 'Nine',
-                         10: 'Ten', 11: 'Jack', 12: 'Queen', 13: 'King'}
-        self.cardSuit = {'c': 'Clubs', 'h': 'Hearts', 's': 'Spades', 'd': 'Diamonds'}
-        self.emotes = blackjack_emotes.blackjack
+# cards are ints from 0 to 51: suit * 13 + rank - 1, suits in the order of SUITS
+SUITS = "chds"
+RANK_NAMES = ("a", "2", "3", "4", "5", "6", "7", "8", "9", "10", "j", "q", "k")
+SUIT_SYMBOLS = {"c": "♣", "h": "♥", "d": "♦", "s": "♠"}
+VALUES = bytes(min(rank, 10) for _ in SUITS for rank in range(1, 14))
+BJ_SETTINGS = getattr(bs, "blackjack_settings", {})
+# server id -> Shoe
+SHOES = {}
 
-    @property
-    def __str__(self) -> str:
-        return self.emotes[f"white_{self.suit}_{self.rank}"]
 
-    def get_rank(self) -> str:
-        """
+def _emote(suit: str, rank: int) -> str:
+    # the emote names are not consistent, aces and kings exist as number and as letter
+    emotes = blackjack_emotes.blackjack
+    name = RANK_NAMES[rank - 1]
+    return emotes.get(f"white_{suit}_{rank}") or emotes.get(f"white_{suit}_{name}") \
+        or f"{name.upper()}{SUIT_SYMBOLS[suit]}"
+
 
-        :rtype: int
+EMOTES = tuple(_emote(suit, rank) for suit in SUITS for rank in range(1, 14))
+
+
+class Shoe:
+    __slots__ = ("decks", "penetration", "cards", "position", "shuffles")
+
+    def __init__(self, decks: int = BJ_SETTINGS.get("decks", 6),
+                 penetration: float = BJ_SETTINGS.get("penetration", 0.75)):
+        """Multiple decks which are reused for many games and only shuffled once the cut card is reached
+        :param decks: int
+        :param penetration: float
+            share of the shoe which is dealt before it is shuffled again
         """
-        return self.rank
+        self.decks = decks
+        self.penetration = penetration
+        self.cards = array("B", range(52)) * decks
+        self.position = 0
+        self.shuffles = 0
+        self.shuffle()
+
+    def shuffle(self):
+        random.shuffle(self.cards)
+        self.position = 0
+        self.shuffles += 1
+
+    def prepare(self):
+        # prepare: called before every game, a game never starts behind the cut card
+        if self.position >= len(self.cards) * self.penetration:
+            self.shuffle()
+
+    def draw(self) -> int:
+        if self.position >= len(self.cards):
+            self.shuffle()
+        card = self.cards[self.position]
+        self.position += 1
+        return card
+
+
+class Hand:
+    __slots__ = ("cards", "hard", "aces")
+
+    def __init__(self):
+        """Keeps the hard total and the number of aces up to date, so the score never has to be counted again"""
+        self.cards = []
+        self.hard = 0
+        self.aces = 0
+
+    def add(self, card: int):
+        self.cards.append(card)
+        value = VALUES[card]
+        self.hard += value
+        if value == 1:
+            self.aces += 1
+
+    @property
+    def soft(self) -> bool:
+        # soft: one ace counts as 11 without busting the hand
+        return self.aces > 0 and self.hard <= 11
 
-    def get_suit(self) -> str:
-        return self.suit
+    @property
+    def total(self) -> int:
+        return self.hard + 10 if self.soft else self.hard
 
-    def bj_value(self) -> int:
-        if self.rank > 9:
-            return 10
-        else:
-            return self.rank
+    @property
+    def blackjack(self) -> bool:
+        return len(self.cards) == 2 and self.total == 21
 
+    def __str__(self) -> str:
+        return ", ".join(EMOTES[card] for card in self.cards)
 
-def bj_hand_counter(hand) -> int:
-    hand_count = 0
-    for card in hand:
-        hand_count += card.bj_value()
-    return hand_count
+
+def get_shoe(server_id: int) -> Shoe:
+    shoe = SHOES.get(server_id)
+    if shoe is None:
+        shoe = SHOES[server_id] = Shoe()
+    return shoe
 
 
 def bj_string_generator(reactions) -> str:
@@ -75,22 +136,16 @@ def bj_string_generator(reactions) -> str:
 
 
 def bj_field_generator(cur_player, hands) -> str:
-    cur_hands = hands[cur_player]
-    return f"Score: {bj_hand_counter(cur_hands)}\n" \
-           f"Cards: {', '.join((i.__str__ for i in cur_hands))}"
+    cur_hand = hands[cur_player]
+    return f"Score: {cur_hand.total}\n" \
+           f"Cards: {cur_hand}"
 
 
-def bj_handle_bot_cards(hand, deck) -> tuple:
-    finished = False
-    busted = False
-    while not finished:
-        if bj_hand_counter(hand['bot']) < 17:
-            hand['bot'].append(deck.pop(0))
-        else:
-            finished = True
-    if bj_hand_counter(hand['bot']) > 21:
-        busted = True
-    return hand, deck, busted
+def bj_handle_bot_cards(hand, shoe) -> tuple:
+    # the dealer stands on all 17s
+    while hand['bot'].total < 17:
+        hand['bot'].add(shoe.draw())
+    return hand, shoe, hand['bot'].total > 21
 
 
 def bj_winner_handler(hand, player_busted: bool, bot_busted: bool, bet: float) -> tuple:
@@ -101,8 +156,8 @@ def bj_winner_handler(hand, player_busted: bool, bot_busted: bool, bet: float) -
     :type player_busted: bool
     :type hand: dict
     """
-    hand_human = bj_hand_counter(hand['human'])
-    hand_bot = bj_hand_counter(hand['bot'])
+    hand_human = hand['human'].total
+    hand_bot = hand['bot'].total
     if player_busted:
         win = False
         msg = "Busted! You lost {}" + bs.currency_name + "..."
@@ -113,7 +168,7 @@ def bj_winner_handler(hand, player_busted: bool, bot_busted: bool, bet: float) -
     elif hand_human > hand_bot:
         win = True
         msg = "You won {}" + bs.currency_name + "!"
-        if bj_hand_counter(hand["human"]) == 21:
+        if hand_human == 21:
             bet *= 1.5
     elif hand_human == hand_bot:
         win = False
@@ -124,3 +179,65 @@ def bj_winner_handler(hand, player_busted: bool, bot_busted: bool, bet: float) -
         msg = "You lost {}" + bs.currency_name + "..."
         bet *= -1.0
     return msg, win, int(round(bet, 0))
+
+
+# benchmark: cpu time and allocated memory blocks per game of the old Card objects against the int shoe
+def main(games: int = 20000):
+    import time
+    import tracemalloc
+
+    class OldCard:
+        def __init__(self, rank, suit):
+            self.rank = rank
+            self.suit = suit
+            self.cardName = {1: 'Ace', 2: 'Two', 3: 'Three', 4: 'Four', 5: 'Five', 6: 'Six', 7: 'Seven',
+                             8: 'Eight', 9: 'Nine', 10: 'Ten', 11: 'Jack', 12: 'Queen', 13: 'King'}
+            self.cardSuit = {'c': 'Clubs', 'h': 'Hearts', 's': 'Spades', 'd': 'Diamonds'}
+            self.emotes = blackjack_emotes.blackjack
+
+        def bj_value(self) -> int:
+            return 10 if self.rank > 9 else self.rank
+
+    def old_counter(cards) -> int:
+        return sum(card.bj_value() for card in cards)
+
+    def old_game():
+        deck = [OldCard(rank, suit) for suit in "chds" for rank in range(1, 14)]
+        random.shuffle(deck)
+        human, bot = [deck.pop(0), deck.pop(0)], [deck.pop(0), deck.pop(0)]
+        while old_counter(human) < 17:
+            human.append(deck.pop(0))
+        while old_counter(bot) < 17:
+            bot.append(deck.pop(0))
+        return human, bot
+
+    shoe = Shoe()
+
+    def new_game():
+        shoe.prepare()
+        human, bot = Hand(), Hand()
+        for _ in range(2):
+            human.add(shoe.draw())
+            bot.add(shoe.draw())
+        while human.total < 17:
+            human.add(shoe.draw())
+        while bot.total < 17:
+            bot.add(shoe.draw())
+        return human, bot
+
+    for name, game in (("Card objects", old_game), ("Int shoe", new_game)):
+        start = time.perf_counter()
+        for _ in range(games):
+            game()
+        cpu = time.perf_counter() - start
+        # the results are kept alive, so every block which belongs to a game shows up in the snapshot
+        tracemalloc.start()
+        results = [game() for _ in range(1000)]
+        blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+        tracemalloc.stop()
+        del results
+        print(f"{name + ':':14}{cpu / games * 1e6:.1f} us and {blocks / 1000:.1f} memory blocks per game")
+
+
+if __name__ == "__main__":
+    main()
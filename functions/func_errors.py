@@ -15,3 +15,15 @@ class DuplicateItem(commands.CommandError):
 
 class WrongDateFormat(commands.CommandError):
     pass
+
+
+class ImageServiceUnavailable(commands.CommandError):
+    pass
+
+
+class TooManySessions(commands.CommandError):
+    pass
+
+
+class ProfilerBusy(commands.CommandError):
+    pass
@@ -1,7 +1,43 @@
-def sort_roles(roles: list, exp: int) -> [dict, dict]:
+from bisect import bisect_right
+
+# server id -> (exp_level_roles list the index was built from, LevelRoleIndex)
+INDEXES = {}
+
+
+class LevelRoleIndex:
+    def __init__(self, roles: list):
+        """Level roles sorted by their required exp
+        :param roles: list
+            the exp_level_roles server setting, dicts with role_id and value
+        """
+        pairs = sorted((item["value"], item["role_id"]) for item in roles or [] if item.get("value") is not None)
+        self.thresholds = [requirement for requirement, _ in pairs]
+        self.role_ids = [role_id for _, role_id in pairs]
+
+    def earned(self, exp: int) -> list:
+        # earned: all role ids with a requirement at or below exp
+        return self.role_ids[:bisect_right(self.thresholds, exp)]
+
+    def crossed(self, old_exp: int, new_exp: int) -> list:
+        # crossed: only the role ids whose requirement was passed while going from old_exp to new_exp
+        return self.role_ids[bisect_right(self.thresholds, old_exp):bisect_right(self.thresholds, new_exp)]
+
+
+def get_index(server_id: int, roles: list) -> LevelRoleIndex:
+    # get_index: returns the cached index, it is rebuilt once the server settings (and with it the list) change
+    cached = INDEXES.get(server_id)
+    if cached is None or cached[0] is not roles:
+        cached = (roles, LevelRoleIndex(roles))
+        INDEXES[server_id] = cached
+    return cached[1]
+
+
+def sort_roles(roles: list, exp: int, server_id: int = None) -> [dict, dict]:
     # filters the input roles and only returns the roles which the user has earned and which ones they will earn next
-    roles_earned = [{"role": item["role"], "requirement": item["requirement"]} for item in roles
-                    if item["requirement"] <= exp]
-    roles_next = [{"role": item["role"], "requirement": item["requirement"]} for item in roles
-                  if item["requirement"] > exp]
+    index = get_index(server_id, roles) if server_id else LevelRoleIndex(roles)
+    position = bisect_right(index.thresholds, exp)
+    roles_earned = [{"role": role_id, "requirement": requirement} for requirement, role_id
+                    in zip(index.thresholds[:position], index.role_ids[:position])]
+    roles_next = [{"role": role_id, "requirement": requirement} for requirement, role_id
+                  in zip(index.thresholds[position:], index.role_ids[position:])]
     return roles_earned, roles_next
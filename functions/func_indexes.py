@@ -0,0 +1,121 @@
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import OperationFailure
+
+from functions import func_database, func_logs
+
+LOG = func_logs.get_logger("indexes")
+
+# collection -> every index the queries in func_database rely on, applied at startup
+INDEXES = {
+    "MemberServerInformation": [
+        IndexModel([("user_id", ASCENDING), ("server_id", ASCENDING)], name="user_server"),
+        IndexModel([("server_id", ASCENDING), ("exp_amount", DESCENDING)], name="server_exp"),
+        IndexModel([("user_id", ASCENDING), ("server_id", ASCENDING), ("items.name", TEXT)], name="items_text"),
+    ],
+    "User": [
+        IndexModel([("user_id", ASCENDING)], name="user"),
+    ],
+    "Server": [
+        IndexModel([("server_id", ASCENDING)], name="server"),
+    ],
+    "ServerItems": [
+        IndexModel([("server_id", ASCENDING), ("item_id", ASCENDING)], name="server_item"),
+        IndexModel([("server_id", ASCENDING), ("name", TEXT), ("description", TEXT)], name="items_text"),
+    ],
+}
+
+# the filters and sorts used by the UserDatabase, ServerDatabase and ItemDatabase methods, the rank queries are built
+# by the same helpers as in func_database
+QUERY_PLANS = [
+    ("UserDatabase.get_user_information", "MemberServerInformation", {"user_id": 1, "server_id": 1}, None),
+    ("UserDatabase.get_user_information_global", "User", {"user_id": 1}, None),
+    ("UserDatabase.user_rank", "MemberServerInformation", func_database.rank_filter(1, "exp_amount", 0), None),
+    ("UserDatabase.user_sort_exp_leaderboard", "MemberServerInformation", func_database.members_filter(1),
+     func_database.leaderboard_sort("exp_amount")),
+    ("UserDatabase.stream_setting", "MemberServerInformation", func_database.members_filter(1), None),
+    ("UserDatabase.get_item", "MemberServerInformation",
+     {"user_id": 1, "server_id": 1, "items": {"$elemMatch": {"item_id": "item"}}}, None),
+    ("UserDatabase.search_items", "MemberServerInformation",
+     {"user_id": 1, "server_id": 1, "$text": {"$search": "item"}}, None),
+    ("ServerDatabase.get_server_information", "Server", {"server_id": 1}, None),
+    ("ItemDatabase.get_items", "ServerItems", {"server_id": 1}, None),
+    ("ItemDatabase.get_shop_items", "ServerItems", {"server_id": 1, "available": "true"}, None),
+    ("ItemDatabase.search_items", "ServerItems", {"server_id": 1, "$text": {"$search": "item"}}, None),
+    ("ItemDatabase.search_shop_items", "ServerItems",
+     {"server_id": 1, "$text": {"$search": "item"}, "available": "true"}, None),
+    ("ItemDatabase.get_item", "ServerItems", {"server_id": 1, "item_id": "item"}, None),
+]
+
+
+def _key(index: dict) -> list:
+    # _key: comparable key of a listed index or an IndexModel document, older servers list 1.0 instead of 1
+    return [(field, int(order) if isinstance(order, float) else order) for field, order in index["key"].items()]
+
+
+async def ensure_indexes(db=None):
+    """Creates the indexes which are missing, a failure is logged and doesn't stop the startup
+    An index is skipped if one with the same keys exists under any name and a text index if the collection has any
+    text index, mongodb only allows one per collection and the $text queries use the existing one
+    """
+    db = db or func_database.Database().db
+    for collection, indexes in INDEXES.items():
+        try:
+            existing = [index async for index in db[collection].list_indexes()]
+        except OperationFailure as error:
+            LOG.error("ensure_indexes could not list the indexes", collection=collection, error=error)
+            continue
+        keys = [_key(index) for index in existing]
+        has_text = any(field == "_fts" for key in keys for field, _ in key)
+        for index in indexes:
+            name = index.document["name"]
+            is_text = any(order == TEXT for _, order in _key(index.document))
+            if (is_text and has_text) or _key(index.document) in keys:
+                LOG.debug("ensure_indexes exists", collection=collection, index=name)
+                continue
+            try:
+                await db[collection].create_indexes([index])
+                LOG.info("ensure_indexes created", collection=collection, index=name)
+            except OperationFailure as error:
+                # e.g. IndexOptionsConflict or IndexKeySpecsConflict with an index which was created by hand
+                LOG.error("ensure_indexes could not create", collection=collection, index=name, error=error)
+
+
+def _stages(plan: dict):
+    # _stages: all stage names of a query plan, including the input stages
+    yield plan.get("stage")
+    for child in [plan.get("inputStage"), *plan.get("inputStages", [])]:
+        if child:
+            yield from _stages(child)
+
+
+async def check_query_plans(db=None) -> list:
+    # check_query_plans: returns the name and winning plan stages of every query which does a collection scan
+    db = db or func_database.Database().db
+    failures = []
+    for name, collection, query, sort in QUERY_PLANS:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explained = await cursor.explain()
+        stages = list(_stages(explained["queryPlanner"]["winningPlan"]))
+        if "COLLSCAN" in stages:
+            failures.append((name, stages))
+    return failures
+
+
+# query plan regression check, run it against a local mongod before deploying
+async def main():
+    await ensure_indexes()
+    failures = await check_query_plans()
+    for name, stages in failures:
+        print(f"COLLSCAN in {name}: {' <- '.join(stages)}")
+    print(f"{len(QUERY_PLANS) - len(failures)}/{len(QUERY_PLANS)} queries use an index")
+    return not failures
+
+
+if __name__ == "__main__":
+    import asyncio
+    import sys
+
+    loop = asyncio.get_event_loop()
+    sys.exit(0 if loop.run_until_complete(main()) else 1)
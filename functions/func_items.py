@@ -4,51 +4,44 @@ import bot_settings
 
 import func_database
 import func_msg_gen
+from functions import func_router
 
 MSG = func_msg_gen.MessageGenerator()
 ITEM_DB = func_database.ItemDatabase()
 USER_DB = func_database.UserDatabase()
 
 
-def shop_embed_generator(items: list, color, user_information: dict) -> [discord.Embed]:
-    try:
-        item_length: int = len(items)
-    except TypeError:
-        item_length: int = 0
-    if item_length == 0:
-        empty_embed = discord.Embed(
+def shop_page_embed(items: list, color, user_information: dict) -> discord.Embed:
+    # shop_page_embed: one page of the shop, built when the page is shown
+    if not items:
+        return discord.Embed(
             title="Item shop",
             description="There are no items available in this server!"
         )
-        return [empty_embed]
-    items = MSG.split_list(items, 6)
-    embeds = []
-    base_embed = discord.Embed(
+    return discord.Embed(
         title="Item Shop",
         description=f"Respond with the number next to the item to buy it.\n"
                     f"Current Balance: {user_information.get('balance', 0)} {bot_settings.currency_name}",
         color=color
+    ).add_field(
+        name="Items:",
+        value="\n".join([f"{bot_settings.digits[position]} {i.get('emoji', '')} "
+                         f"**{i.get('name')}**\n"
+                         f"`{i['store'].get('price', 0)}` {bot_settings.currency_name} | Type `{i.get('type')}`"
+                         for position, i in enumerate(items, 1)])
     )
-    for item_page in items:
-        item_embed = base_embed.copy().add_field(
-            name="Items:",
-            value="\n".join([f"{bot_settings.digits[item_page.index(i) + 1]} {i.get('emoji', '')} "
-                             f"**{i.get('name')}**\n"
-                             f"`{i['store'].get('price', 0)}` {bot_settings.currency_name} | Type `{i.get('type')}`"
-                             for i in item_page])
-        )
-        embeds.append(item_embed)
-    return embeds
 
 
 async def shop_choice_handler(response: discord.Message, self_object):
-    items: list = self_object.items
-    cur_page: int = self_object.current
+    # only the shown page has to be loaded, the chosen item is always on it
+    items: list = await self_object.source.fetch(self_object.current)
     ctx = self_object.ctx
     guser_information, luser_information = await ctx.get_user_information()
+    # the income of the last messages may still be in the write buffer
+    balance = await USER_DB.get_buffered_amount(ctx.author.id, ctx.guild.id, "balance")
     try:
-        selected_item: dict = items[(int(response.content) + (cur_page * self_object.items_per_page)) - 1]
-    except ValueError or TypeError:
+        selected_item: dict = items[int(response.content) - 1]
+    except (ValueError, IndexError):
         return await MSG.error_msg(ctx, "Invalid item choice. "
                                         "Please only reply with the number next to the item!")
     user_item = {}
@@ -59,16 +52,12 @@ async def shop_choice_handler(response: discord.Message, self_object):
     item_msg = await ctx.send(embed=shop_item_embed(
         selected_item,
         guser_information.get("embed_color", bot_settings.embed_color),
-        luser_information.get("balance", 0),
+        balance,
         user_item
     ))
     try:
-        response = await ctx.bot.wait_for(
-            "message",
-            check=lambda m: ctx.author.id == m.author.id
-                            and m.channel.id == ctx.channel.id
-                            and m.content.lower() in ["confirm", "cancel"],
-            timeout=180
+        response = await func_router.ROUTER.wait_for_message(
+            ctx.channel.id, ctx.author.id, check=lambda m: m.content.lower() in ["confirm", "cancel"], timeout=180
         )
         response = response.content.lower()
     except Exception:
@@ -84,7 +73,7 @@ async def shop_choice_handler(response: discord.Message, self_object):
         except IndexError:
             user_item = {}
         # check if the user has enough funds to buy the item
-        if luser_information.get("balance", 0) < store_information["price"]:
+        if balance < store_information["price"]:
             return await MSG.error_msg(
                 ctx,
                 "You don't have enough money to purchase this item!"
@@ -171,33 +160,23 @@ def shop_item_embed(item: dict, color, user_balance: int, user_item: dict) -> di
     return embed
 
 
-def item_embed_generator(items: list, color) -> [discord.Embed]:
-    try:
-        item_length: int = len(items)
-    except TypeError:
-        item_length: int = 0
-    if item_length == 0:
-        empty_embed = discord.Embed(
+def item_page_embed(items: list, color) -> discord.Embed:
+    # item_page_embed: one page of the item menu, built when the page is shown
+    if not items:
+        return discord.Embed(
             title="Item Menu",
             description="You don't own any items currently!"
         )
-        return [empty_embed]
-    items = MSG.split_list(items, 6)
-    embeds = []
-    base_embed = discord.Embed(
+    return discord.Embed(
         title="Item Menu",
         description=f"Respond with the number next to the item to use it!",
         color=color
+    ).add_field(
+        name="Items:",
+        value="\n".join([f"{bot_settings.digits[position]} **{i.get('name')}**\n"
+                         f"`x{i.get('amount', 0)}` | Used {i.get('usage', 0)} times"
+                         for position, i in enumerate(items, 1)])
     )
-    for item_page in items:
-        item_embed = base_embed.copy().add_field(
-            name="Items:",
-            value="\n".join([f"{bot_settings.digits[item_page.index(i) + 1]} **{i.get('name')}**\n"
-                             f"`x{i.get('amount', 0)}` | Used {i.get('usage', 0)} times"
-                             for i in item_page])
-        )
-        embeds.append(item_embed)
-    return embeds
 
 
 def item_usage_embed(user_item: dict, item: dict, color) -> discord.Embed:
@@ -223,13 +202,13 @@ def item_usage_embed(user_item: dict, item: dict, color) -> discord.Embed:
 
 
 async def item_choice_handler(response: discord.Message, self_object):
-    items: list = self_object.items
-    cur_page: int = self_object.current
+    # only the shown page has to be loaded, the chosen item is always on it
+    items: list = await self_object.source.fetch(self_object.current)
     ctx = self_object.ctx
     guser_information, luser_information = await ctx.get_user_information()
     try:
-        selected_item: dict = items[(int(response.content) + (cur_page * self_object.items_per_page)) - 1]
-    except ValueError or TypeError:
+        selected_item: dict = items[int(response.content) - 1]
+    except (ValueError, IndexError):
         return await MSG.error_msg(ctx, "Invalid item choice. "
                                         "Please only reply with the number next to the item!")
     item_information = await ITEM_DB.get_item(ctx.guild.id, selected_item["item_id"])
@@ -239,12 +218,8 @@ async def item_choice_handler(response: discord.Message, self_object):
         guser_information.get("embed_color", bot_settings.embed_color),
     ))
     try:
-        response = await ctx.bot.wait_for(
-            "message",
-            check=lambda m: ctx.author.id == m.author.id
-                            and m.channel.id == ctx.channel.id
-                            and m.content.lower() in ["use", "cancel"],
-            timeout=180
+        response = await func_router.ROUTER.wait_for_message(
+            ctx.channel.id, ctx.author.id, check=lambda m: m.content.lower() in ["use", "cancel"], timeout=180
         )
         response = response.content.lower()
     except Exception:
@@ -0,0 +1,102 @@
+import bot_settings
+from functions import func_redis
+
+LEADERBOARD_SETTINGS = getattr(bot_settings, "leaderboard_settings", {})
+
+
+class LeaderboardMirror:
+    def __init__(self, setting: str = "exp_amount"):
+        """Optional per server redis sorted set which mirrors the exp of every member
+        :param setting: str
+            the MemberServerInformation field which is mirrored
+        """
+        self.setting = setting
+        self.enabled = LEADERBOARD_SETTINGS.get("mirror", False)
+        # server_id -> {user_id: total} written while the server is rebuilt, they are newer than the streamed ones
+        self.rebuilding = {}
+
+    @property
+    def cache(self):
+        return func_redis.MANAGER.get("leaderboard")
+
+    def _key(self, server_id: int) -> str:
+        return f"leaderboard:{self.setting}:{server_id}"
+
+    def _ready_key(self, server_id: int) -> str:
+        # set by rebuild, before that the sorted set only holds the members who were active since it was enabled
+        return f"leaderboard:{self.setting}:{server_id}:ready"
+
+    async def set(self, server_id: int, user_id: int, total: int):
+        # set: always the absolute total, an increment would create missing members with only the delta as score
+        writes = self.rebuilding.get(server_id)
+        if writes is not None:
+            writes[user_id] = total
+        await self.cache.zadd(self._key(server_id), total, user_id)
+
+    async def rank(self, server_id: int, user_id: int):
+        # rank: 1 based position or None if the user is not mirrored or the server was never rebuilt
+        pipe = self.cache.pipeline()
+        pipe.exists(self._ready_key(server_id))
+        pipe.zrevrank(self._key(server_id), user_id)
+        ready, rank = await pipe.execute()
+        return None if not ready or rank is None else rank + 1
+
+    async def page(self, server_id: int, offset: int = 0, limit: int = 10) -> list:
+        # page: same format as UserDatabase.user_sort_exp_leaderboard, empty if the server was never rebuilt
+        pipe = self.cache.pipeline()
+        pipe.exists(self._ready_key(server_id))
+        pipe.zrevrange(self._key(server_id), offset, offset + limit - 1, withscores=True)
+        ready, result = await pipe.execute()
+        if not ready:
+            return []
+        return [{"user_id": int(user_id), self.setting: int(score)} for user_id, score in result]
+
+    async def rebuild(self, server_id: int, udb, batch_size: int = 1000) -> int:
+        """Streams the members into a temporary key and swaps it with the live one when finished
+        :param udb: func_database.UserDatabase
+            its increment buffer is flushed first, so the streamed documents contain the buffered exp
+        :return: int
+            the number of mirrored members
+        """
+        if server_id in self.rebuilding:
+            raise RuntimeError(f"The leaderboard of {server_id} is already being rebuilt")
+        key = self._key(server_id)
+        temporary_key = f"{key}:rebuild"
+        writes = self.rebuilding[server_id] = {}
+        try:
+            await udb.flush_increments()
+            await self.cache.delete(temporary_key)
+            count = 0
+            batch = []
+            async for member in udb.stream_setting(server_id, self.setting, batch_size=batch_size):
+                batch += [member.get(self.setting, 0), member["user_id"]]
+                if len(batch) >= batch_size * 2:
+                    await self.cache.zadd(temporary_key, *batch)
+                    count += len(batch) // 2
+                    batch = []
+            if batch:
+                await self.cache.zadd(temporary_key, *batch)
+                count += len(batch) // 2
+            # the totals written during the stream go on top of it and the swap happens in the same transaction
+            replayed = dict(writes)
+            transaction = self.cache.multi_exec()
+            if replayed:
+                transaction.zadd(temporary_key, *[value for user_id, total in replayed.items()
+                                                  for value in (total, user_id)])
+            if count or replayed:
+                transaction.rename(temporary_key, key)
+            else:
+                transaction.delete(key)
+            transaction.set(self._ready_key(server_id), 1)
+            await transaction.execute()
+            # writes which came in while the transaction was sent may have been overwritten by the rename
+            late = [value for user_id, total in writes.items() if replayed.get(user_id) != total
+                    for value in (total, user_id)]
+            if late:
+                await self.cache.zadd(key, *late)
+        finally:
+            del self.rebuilding[server_id]
+        return count
+
+
+MIRROR = LeaderboardMirror()
@@ -0,0 +1,108 @@
+import asyncio
+import contextvars
+
+from functions import func_database, func_cache
+
+# the loader of the message which is currently being processed, set in FullBot.get_context
+CURRENT = contextvars.ContextVar("request_loader", default=None)
+
+
+class BatchLoader:
+    def __init__(self, collection, local: bool):
+        """Collects the documents requested during one loop iteration and loads them with one $in query
+        :param collection: the motor collection
+        :param local: bool
+            True if the keys are (user_id, server_id) tuples, False if they are user ids
+        """
+        self.collection = collection
+        self.local = local
+        self.pending = {}
+        self.batches = 0
+        self.loaded = 0
+        func_cache.register_stats(self)
+
+    def load(self, key) -> asyncio.Future:
+        future = self.pending.get(key)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            if not self.pending:
+                loop.call_soon(lambda: asyncio.ensure_future(self._dispatch()))
+            future = loop.create_future()
+            self.pending[key] = future
+        return future
+
+    def _query(self, keys: list) -> dict:
+        if not self.local:
+            return {"user_id": {"$in": keys}}
+        servers = {}
+        for user_id, server_id in keys:
+            servers.setdefault(server_id, []).append(user_id)
+        queries = [{"server_id": server_id, "user_id": {"$in": user_ids}} for server_id, user_ids in servers.items()]
+        return queries[0] if len(queries) == 1 else {"$or": queries}
+
+    async def _dispatch(self):
+        pending, self.pending = self.pending, {}
+        try:
+            documents = await self.collection.find(self._query(list(pending.keys()))).to_list(None)
+        except Exception as error:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            return
+        self.batches += 1
+        self.loaded += len(pending)
+        found = {(document["user_id"], document["server_id"]) if self.local else document["user_id"]: document
+                 for document in documents}
+        for key, future in pending.items():
+            if not future.done():
+                future.set_result(found.get(key, {}))
+
+    def stats(self) -> dict:
+        return {
+            "name": f"batch_loader_{self.collection.name}",
+            "batches": self.batches,
+            "documents": self.loaded,
+            "documents_per_batch": round(self.loaded / self.batches, 2) if self.batches else 0.0
+        }
+
+
+class RequestLoader:
+    def __init__(self):
+        """Per message cache of user and server documents, every document is only requested once"""
+        self.documents = {}
+
+    async def _get(self, key, load):
+        # the first caller loads the document, everyone after that gets the same copy
+        task = self.documents.get(key)
+        if task is None:
+            task = asyncio.ensure_future(load())
+            self.documents[key] = task
+        return await asyncio.shield(task)
+
+    async def get_global(self, user_id: int) -> dict:
+        return await self._get(("global", user_id), lambda: _copy(GLOBAL_USERS.load(user_id)))
+
+    async def get_local(self, user_id: int, server_id: int) -> dict:
+        return await self._get(("local", user_id, server_id), lambda: _copy(LOCAL_USERS.load((user_id, server_id))))
+
+    async def get_server(self, server_id: int) -> dict:
+        return await self._get(("server", server_id), lambda: SDB.get_server_settings(server_id))
+
+    async def get_user(self, user_id: int, server_id: int) -> tuple:
+        # get_user: global and local document, loaded concurrently
+        return tuple(await asyncio.gather(self.get_global(user_id), self.get_local(user_id, server_id)))
+
+
+async def _copy(future) -> dict:
+    # the batch results can be shared by concurrent messages, so every request gets its own copy
+    return dict(await asyncio.shield(future))
+
+
+def current():
+    return CURRENT.get()
+
+
+UDB = func_database.UserDatabase()
+SDB = func_database.ServerDatabase()
+GLOBAL_USERS = BatchLoader(UDB.collection, local=False)
+LOCAL_USERS = BatchLoader(UDB.local_db, local=True)
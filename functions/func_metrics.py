@@ -0,0 +1,296 @@
+import asyncio
+import functools
+import inspect
+import time
+from bisect import bisect_left
+
+from aiohttp import web
+
+import bot_settings
+from functions import func_cache, func_logs
+
+METRICS_SETTINGS = getattr(bot_settings, "metrics_settings", {})
+LOG = func_logs.get_logger("metrics")
+# seconds, from a cached redis call up to a slow image render
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        # label values -> count
+        self.values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        """Latencies in fixed buckets, an observation is one bisect and two additions
+        :param buckets: tuple
+            upper bounds in seconds, +Inf is added when the histogram is exposed
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket (the last one is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value: float, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def time(self, *label_values):
+        # time: decorator for coroutine functions, the label values are fixed per function
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, *label_values)
+            return wrapper
+        return decorator
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                bucket_labels = _labels(self.labels, label_values, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        metric = Counter(name, documentation, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        # render: the prometheus text format, the stats of the caches and buffers are read at scrape time
+        lines = []
+        for metric in self.metrics:
+            lines += metric.expose()
+        lines += ["# HELP bot_stat Numeric values from the cache stats, same as sbot cache", "# TYPE bot_stat gauge"]
+        for stats in func_cache.all_stats():
+            for field, value in stats.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"bot_stat{_labels(('source', 'field'), (stats['name'], field))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+COMMANDS = REGISTRY.histogram("bot_command_seconds", "Command latency from before to after invoke",
+                              ("command", "status"))
+DATABASE = REGISTRY.histogram("bot_database_seconds", "Latency of the database methods", ("method",))
+ON_MESSAGE = REGISTRY.histogram("bot_on_message_seconds", "Time spent in on_message_handlers")
+IMAGES = REGISTRY.histogram("bot_rank_card_seconds", "Latency of rendering a rank card which wasn't cached",
+                            ("backend", "status"))
+CACHE_REQUESTS = REGISTRY.counter("bot_cache_requests_total", "Lookups of the shared caches", ("cache", "result"))
+
+
+class TimedCursor:
+    __slots__ = ("cursor", "histogram", "label", "elapsed")
+
+    def __init__(self, cursor, histogram: Histogram, label: str):
+        """Motor cursor which observes the round trips of to_list, distinct and async iteration, building the
+        cursor doesn't talk to the database"""
+        self.cursor = cursor
+        self.histogram = histogram
+        self.label = label
+        self.elapsed = 0.0
+
+    def __getattr__(self, name):
+        attribute = getattr(self.cursor, name)
+        if not callable(attribute):
+            return attribute
+
+        def chained(*args, **kwargs):
+            # sort, skip, limit and the like return the cursor itself, the timing has to stay on it
+            result = attribute(*args, **kwargs)
+            return self if result is self.cursor else result
+        return chained
+
+    async def _timed(self, coroutine):
+        start = time.perf_counter()
+        try:
+            return await coroutine
+        finally:
+            self.histogram.observe(time.perf_counter() - start, self.label)
+
+    def to_list(self, length):
+        return self._timed(self.cursor.to_list(length))
+
+    def distinct(self, key: str):
+        return self._timed(self.cursor.distinct(key))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # the batches of one iteration are observed together once it is exhausted
+        start = time.perf_counter()
+        try:
+            return await self.cursor.__anext__()
+        except StopAsyncIteration:
+            self.histogram.observe(self.elapsed + time.perf_counter() - start, self.label)
+            raise
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+
+def _is_cursor(result) -> bool:
+    return hasattr(result, "to_list") and hasattr(result, "distinct")
+
+
+def _time_method(histogram: Histogram, label: str, method):
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = await method(*args, **kwargs)
+            except Exception:
+                histogram.observe(time.perf_counter() - start, label)
+                raise
+            if _is_cursor(result):
+                return TimedCursor(result, histogram, label)
+            histogram.observe(time.perf_counter() - start, label)
+            return result
+        return wrapper
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        result = method(*args, **kwargs)
+        return TimedCursor(result, histogram, label) if _is_cursor(result) else result
+    return wrapper
+
+
+def timed_methods(histogram: Histogram):
+    """Class decorator, every public method is observed with "Class.method" as label
+    coroutines are observed until they return, methods which return a motor cursor when the cursor fetches its
+    results, the database isn't contacted before that
+    """
+    def decorator(cls):
+        for name, method in list(vars(cls).items()):
+            if not name.startswith("_") and inspect.isfunction(method):
+                setattr(cls, name, _time_method(histogram, f"{cls.__name__}.{name}", method))
+        return cls
+    return decorator
+
+
+async def before_invoke(ctx):
+    ctx.metrics_start = time.perf_counter()
+
+
+async def after_invoke(ctx):
+    start = getattr(ctx, "metrics_start", None)
+    if start is not None:
+        COMMANDS.observe(time.perf_counter() - start, ctx.command.qualified_name,
+                         "error" if ctx.command_failed else "ok")
+
+
+class MetricsServer:
+    def __init__(self, host: str = METRICS_SETTINGS.get("host", "127.0.0.1"),
+                 port: int = METRICS_SETTINGS.get("port", 9100)):
+        """Serves REGISTRY on /metrics, meant to be bound to localhost and scraped by prometheus"""
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def _handle(self, request):
+        return web.Response(body=REGISTRY.render().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def start(self):
+        if self.runner is not None or not METRICS_SETTINGS.get("enabled", True):
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        try:
+            await web.TCPSite(self.runner, self.host, self.port).start()
+        except OSError as error:
+            LOG.error("MetricsServer could not bind", host=self.host, port=self.port, error=error)
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+SERVER = MetricsServer()
+
+
+# benchmark: overhead of one histogram observation and of a timed coroutine, and the time of one scrape
+async def main(observations: int = 200000):
+    histogram = Histogram("benchmark_seconds", "benchmark", ("method",))
+
+    async def work():
+        pass
+
+    timed = histogram.time("work")(work)
+    start = time.perf_counter()
+    for i in range(observations):
+        histogram.observe(i / observations, "observe")
+    observe = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(observations):
+        await work()
+    plain = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(observations):
+        await timed()
+    wrapped = time.perf_counter() - start
+    REGISTRY.metrics.append(histogram)
+    start = time.perf_counter()
+    REGISTRY.render()
+    print(f"observe:        {observe / observations * 1e9:.0f} ns\n"
+          f"timed overhead: {(wrapped - plain) / observations * 1e9:.0f} ns per call\n"
+          f"scrape:         {(time.perf_counter() - start) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
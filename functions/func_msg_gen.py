@@ -1,11 +1,16 @@
+import asyncio
 import copy
-from asyncio import TimeoutError as AsyncioTimeoutError, FIRST_COMPLETED as ASYNCIO_FIRST_COMPLETED, wait as async_wait
-from typing import Union
+from asyncio import TimeoutError as AsyncioTimeoutError
+from collections import OrderedDict
+from typing import Optional, Union
 
 import discord
 from discord.ext import commands
 
 import bot_settings
+from functions import func_router, func_outbox, func_logs
+
+LOG = func_logs.get_logger("paginator")
 
 
 class MessageGenerator:
@@ -30,7 +35,19 @@ class MessageGenerator:
         else:
             colour = color or embed.color
         embed.colour = colour
-        return await ctx.send(self.msg_gen(ctx), embed=embed, file=file)
+        return await func_outbox.OUTBOX.send(ctx.channel, content=self.msg_gen(ctx), embed=embed, file=file)
+
+    @staticmethod
+    def edit(message: discord.Message, **fields) -> asyncio.Future:
+        """Queues an edit, edits of the same message which haven't been sent yet are merged into one
+        :return: asyncio.Future
+            done once the edit was sent, doesn't have to be awaited
+        """
+        return func_outbox.OUTBOX.edit(message, **fields)
+
+    @staticmethod
+    def remove_reaction(message: discord.Message, emoji, member) -> asyncio.Future:
+        return func_outbox.OUTBOX.remove_reaction(message, emoji, member)
 
     async def error_msg(self, ctx, msg) -> discord.Message:
         embed = discord.Embed(title="Something went wrong!", description=msg, color=self.error_embed)
@@ -81,9 +98,134 @@ class MessageGenerator:
         return list_output
 
 
+class PageSource:
+    def __init__(self, items_per_page: int = 1, render=None, lookahead: int = 1, cache_size: int = 5):
+        """Builds the pages of a Paginator when they are shown instead of all of them up front
+        :param render: func
+            (items of the page, page number) -> discord.Embed, gets an empty list if there are no items at all
+        :param lookahead: int
+            pages after the shown one which are rendered in the background
+        :param cache_size: int
+            rendered pages which are kept
+        """
+        self.items_per_page = items_per_page
+        self.render = render
+        self.lookahead = lookahead
+        self.cache_size = cache_size
+        # None until the end of the items is known
+        self.page_count: Optional[int] = None
+        self.pages = OrderedDict()
+        self.tasks = {}
+        # pages a get_page call is waiting for, close leaves their tasks alone
+        self.awaited = set()
+
+    async def fetch(self, page: int) -> list:
+        # fetch: the items of the page, an empty list after the last page
+        raise NotImplementedError
+
+    async def _render(self, page: int) -> Optional[discord.Embed]:
+        items = await self.fetch(page)
+        if not items and page > 0:
+            return None
+        embed = self.render(items, page)
+        self.pages[page] = embed
+        while len(self.pages) > self.cache_size:
+            self.pages.popitem(last=False)
+        return embed
+
+    async def get_page(self, page: int) -> Optional[discord.Embed]:
+        # get_page: None if the page is after the last page
+        if self.page_count is not None and page >= self.page_count:
+            return None
+        if page in self.pages:
+            self.pages.move_to_end(page)
+            embed = self.pages[page]
+        else:
+            task = self.tasks.get(page) or self._start(page)
+            self.awaited.add(page)
+            try:
+                embed = await asyncio.shield(task)
+            finally:
+                self.awaited.discard(page)
+        if embed is not None:
+            self._prefetch(page)
+        return embed
+
+    def _prefetch(self, page: int):
+        for next_page in range(page + 1, page + 1 + self.lookahead):
+            if (self.page_count is None or next_page < self.page_count) and next_page not in self.pages \
+                    and next_page not in self.tasks:
+                self._start(next_page)
+
+    def _start(self, page: int) -> asyncio.Task:
+        task = self.tasks[page] = asyncio.ensure_future(self._render(page))
+        task.add_done_callback(lambda done: self._finished(page, done))
+        return task
+
+    def _finished(self, page: int, task: asyncio.Task):
+        # a failed page is dropped so the next get_page tries it again, the error of a prefetch nobody awaits is
+        # retrieved and logged here
+        if self.tasks.get(page) is task:
+            del self.tasks[page]
+        if not task.cancelled() and task.exception() is not None:
+            LOG.error("PageSource could not render a page", page=page, error=task.exception())
+
+    def close(self):
+        # only the prefetches are cancelled, a page which is awaited is finished and then not used anymore
+        for page, task in list(self.tasks.items()):
+            if page not in self.awaited:
+                task.cancel()
+        self.pages.clear()
+
+
+class ListPageSource(PageSource):
+    def __init__(self, items: list, items_per_page: int = 1, render=None, **kwargs):
+        """Items which are already in memory, only the embeds are built lazily"""
+        super().__init__(items_per_page, render, **kwargs)
+        self.items = items
+        self.page_count = max(-(-len(items) // items_per_page), 1)
+
+    async def fetch(self, page: int) -> list:
+        return self.items[page * self.items_per_page:(page + 1) * self.items_per_page]
+
+
+class EmbedPageSource(ListPageSource):
+    def __init__(self, embeds: list):
+        """The pages which were added with Paginator.add_page"""
+        super().__init__(embeds, 1, lambda items, page: items[0], lookahead=0, cache_size=0)
+
+    async def get_page(self, page: int) -> Optional[discord.Embed]:
+        return self.items[page] if page < len(self.items) else None
+
+
+class CursorPageSource(PageSource):
+    def __init__(self, cursor, items_per_page: int = 1, render=None, **kwargs):
+        """Reads the items from a motor cursor while the user pages through them, the first page only needs the
+        first batch no matter how many items the cursor has"""
+        super().__init__(items_per_page, render, **kwargs)
+        self.cursor = cursor
+        if hasattr(cursor, "batch_size"):
+            cursor.batch_size(items_per_page * (self.lookahead + 1))
+        # every item read so far, pages can be shown again after they were dropped from the cache
+        self.items = []
+        self.lock = asyncio.Lock()
+
+    async def fetch(self, page: int) -> list:
+        end = (page + 1) * self.items_per_page
+        async with self.lock:
+            if self.page_count is None and len(self.items) < end:
+                missing = end - len(self.items)
+                batch = await self.cursor.to_list(length=missing)
+                self.items += batch
+                if len(batch) < missing:
+                    self.page_count = max(-(-len(self.items) // self.items_per_page), 1)
+        return self.items[page * self.items_per_page:end]
+
+
 class Paginator:
     def __init__(self, ctx: commands.Context, reactions: Union[list, tuple] = None, timeout: int = 120,
-                 func=None, close_after_func=True, func_check=None, items=None, items_per_page: int = 5):
+                 func=None, close_after_func=True, func_check=None, items=None, items_per_page: int = 5,
+                 source: PageSource = None):
         """
 
         Parameters
@@ -96,6 +238,8 @@ class Paginator:
         timeout : int
           Timeout in seconds (default: 120)
         func
+        source : Optional[PageSource]
+          Builds the pages on demand, the pages added with add_page are used if None
 
         """
         if items is None:
@@ -111,15 +255,15 @@ class Paginator:
         self.func_check = func_check
         self.msg = MessageGenerator()
         self.items = items
-        self.author_check_reaction = lambda r, u: u.id == self.ctx.author.id \
-                                                  and r.emoji in self.reactions and r.message.id == self.controller.id
-        self.author_check_message = lambda m: self.ctx.author.id == m.author.id \
-                                              and m.channel.id == self.controller.channel.id
         self.items_per_page: int = items_per_page
+        self.source: PageSource = source
 
     async def close_paginator(self):
         # cleanup
         try:
+            if self.source:
+                self.source.close()
+            func_outbox.OUTBOX.discard(self.controller)
             await self.controller.delete()
             del self.reactions
             del self.pages
@@ -141,57 +285,41 @@ class Paginator:
         self.pages = []
 
     async def start_paginator(self, start_page: int = 0):
-        pages = self.pages[start_page:] + self.pages[:start_page]
-        if len(pages) != len(self.pages):
+        with func_router.ROUTER.session(self.ctx.author.id):
+            await self._run(start_page)
+
+    async def _run(self, start_page: int):
+        if self.source is None:
+            self.source = EmbedPageSource(self.pages)
+        embed = await self.source.get_page(start_page)
+        if embed is None or start_page < 0:
             raise IndexError(f"{start_page} is not a valid starting page!")
-        information_value = f"{'Respond with the numbers to change the settings or exit to close the menu.'}" \
-            if self.func else ""
-        if not pages[self.current].fields:
-            pages[self.current].add_field(
-                name="Information:",
-                value=f"Page: {self.current + 1}/{len(self.pages)}\n{information_value}"
-            )
-        self.controller = await self.msg.message_sender(ctx=self.ctx, embed=pages[0])
+        self.current = start_page
+        self.controller = await self.msg.message_sender(ctx=self.ctx, embed=self.information(embed))
         for emoji in self.reactions:
             await self.controller.add_reaction(emoji)
 
         while True:
+            # reactions on the controller and, if there is a func, messages of the author in the same channel
             try:
-                # handle reactions
-                tasks = [
-                    self.ctx.bot.wait_for('reaction_add',
-                                          timeout=self.timeout, check=self.author_check_reaction),
-                    self.ctx.bot.wait_for('reaction_remove',
-                                          timeout=self.timeout, check=self.author_check_reaction)]
-                # handle messages
-                if self.func_check:
-                    tasks.append(
-                        self.ctx.bot.wait_for("message",
-                                              timeout=self.timeout, check=self.func_check and self.author_check_message)
-                    )
-
-                tasks_result, tasks = await async_wait(tasks, return_when=ASYNCIO_FIRST_COMPLETED)
-
-                for task in tasks:
-                    task.cancel()
-                for task in tasks_result:
-                    response = await task
+                event, response = await func_router.ROUTER.wait(
+                    self.ctx.author.id, message_id=self.controller.id, emojis=self.reactions, removals=True,
+                    channel_id=self.controller.channel.id if self.func_check else None, timeout=self.timeout
+                )
             except AsyncioTimeoutError:
                 break
-            except Exception as e:
-                pass
 
-            if type(response) == tuple:
-                if response[0].emoji == self.reactions[0]:
-                    self.current = self.current - 1 if self.current > 0 else len(self.pages) - 1
-                    await self.edit_controller(embed=self.pages[self.current])
+            if event == "reaction":
+                if response.emoji == self.reactions[0]:
+                    # the last page is only known once the source has been read to the end
+                    if self.current > 0 or self.source.page_count:
+                        await self.show_page(self.current - 1 if self.current > 0 else self.source.page_count - 1)
 
-                elif response[0].emoji == self.reactions[1]:
+                elif response.emoji == self.reactions[1]:
                     break
 
-                elif response[0].emoji == self.reactions[2]:
-                    self.current = self.current + 1 if self.current < len(self.pages) - 1 else 0
-                    await self.edit_controller(embed=self.pages[self.current])
+                elif response.emoji == self.reactions[2]:
+                    await self.show_page(self.current + 1)
             else:
                 if self.func:
                     await self.func(response, copy.copy(self))
@@ -200,12 +328,26 @@ class Paginator:
                     break
         await self.close_paginator()
 
-    async def edit_controller(self, embed):
+    async def show_page(self, page: int):
+        embed = await self.source.get_page(page)
+        if embed is None:
+            page, embed = 0, await self.source.get_page(0)
+        self.current = page
+        await self.edit_controller(embed)
+
+    def information(self, embed: discord.Embed) -> discord.Embed:
+        # information: the cached page stays as it is, the page number is added to a copy
+        if embed.fields:
+            return embed
         information_value = f"{'Respond with the numbers to change the settings or exit to close the menu.'}" \
             if self.func else ""
-        if len(self.pages) > 1 and not embed.fields:
-            embed.add_field(
-                name="Information:",
-                value=f"Page: {self.current + 1}/{len(self.pages)}\n{information_value}"
-            )
-        await self.controller.edit(embed=embed)
+        embed = embed.copy()
+        embed.add_field(
+            name="Information:",
+            value=f"Page: {self.current + 1}/{self.source.page_count or '?'}\n{information_value}"
+        )
+        return embed
+
+    async def edit_controller(self, embed):
+        # not awaited, the paginator keeps listening while the edit waits for the rate limit
+        self.msg.edit(self.controller, embed=self.information(embed))
@@ -0,0 +1,206 @@
+import asyncio
+import itertools
+import time
+from collections import OrderedDict
+
+import discord
+
+from functions import func_cache, func_logs
+
+LOG = func_logs.get_logger("outbox")
+
+# route -> (requests, per seconds) for one channel, the limits discord currently sends for these routes
+ROUTES = {
+    "send": (5, 5.0),
+    "edit": (5, 5.0),
+    "reaction": (1, 0.25),
+}
+
+
+class Bucket:
+    __slots__ = ("rate", "per", "tokens", "updated", "pending", "task")
+
+    def __init__(self, rate: int, per: float):
+        """Token bucket of one route in one channel with the jobs which are waiting for it"""
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        # key -> Job, in the order the jobs were queued
+        self.pending = OrderedDict()
+        self.task = None
+
+    def acquire(self) -> float:
+        # acquire: takes a token and returns 0, or returns the seconds until the next token
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) * self.per / self.rate
+
+    def pause(self):
+        # pause: after a 429 the next request waits a full period
+        self.tokens = 1 - self.rate
+        self.updated = time.monotonic()
+
+
+class Job:
+    __slots__ = ("send", "kwargs", "future")
+
+    def __init__(self, send, kwargs: dict, future: asyncio.Future):
+        self.send = send
+        self.kwargs = kwargs
+        self.future = future
+
+
+def _consume(future: asyncio.Future):
+    # the errors are logged by the queue, a caller which doesn't await the future shouldn't cause warnings
+    if not future.cancelled():
+        future.exception()
+
+
+class OutboundQueue:
+    def __init__(self, routes: dict = None):
+        """Sends, edits and reaction removals paced per channel and route, edits of the same message which are
+        still waiting are merged into one edit with the latest state"""
+        self.routes = routes or ROUTES
+        # (route, channel_id) -> Bucket
+        self.buckets = {}
+        self.unique = itertools.count()
+        self.sent = 0
+        self.coalesced = 0
+        self.rate_limited = 0
+        func_cache.register_stats(self)
+
+    def _enqueue(self, route: str, channel_id: int, key, send, kwargs: dict) -> asyncio.Future:
+        bucket = self.buckets.get((route, channel_id))
+        if bucket is None:
+            bucket = self.buckets[(route, channel_id)] = Bucket(*self.routes[route])
+        job = bucket.pending.get(key)
+        if job is not None:
+            # a newer state of a job which hasn't been sent yet, only the latest one is sent
+            job.kwargs.update(kwargs)
+            self.coalesced += 1
+            return job.future
+        future = asyncio.get_event_loop().create_future()
+        future.add_done_callback(_consume)
+        bucket.pending[key] = Job(send, kwargs, future)
+        if bucket.task is None:
+            bucket.task = asyncio.ensure_future(self._drain(route, channel_id, bucket))
+        return future
+
+    async def send(self, channel, **fields) -> discord.Message:
+        # send: new messages are paced but never merged
+        return await self._enqueue("send", channel.id, next(self.unique), channel.send, fields)
+
+    def edit(self, message: discord.Message, **fields) -> asyncio.Future:
+        return self._enqueue("edit", message.channel.id, message.id, message.edit, fields)
+
+    def remove_reaction(self, message: discord.Message, emoji, member) -> asyncio.Future:
+        return self._enqueue("reaction", message.channel.id, (message.id, str(emoji), member.id),
+                             message.remove_reaction, {"emoji": emoji, "member": member})
+
+    def discard(self, message: discord.Message):
+        # discard: drops the edits and reaction removals of a message which is about to be deleted
+        for route in ("edit", "reaction"):
+            bucket = self.buckets.get((route, message.channel.id))
+            if bucket is None:
+                continue
+            for key in [key for key in bucket.pending if key == message.id or
+                        (isinstance(key, tuple) and key[0] == message.id)]:
+                bucket.pending.pop(key).future.cancel()
+
+    async def _drain(self, route: str, channel_id: int, bucket: Bucket):
+        try:
+            while bucket.pending:
+                delay = bucket.acquire()
+                if delay:
+                    await asyncio.sleep(delay)
+                    continue
+                key, job = bucket.pending.popitem(last=False)
+                try:
+                    result = await job.send(**job.kwargs)
+                except discord.HTTPException as error:
+                    if error.status == 429:
+                        self.rate_limited += 1
+                        bucket.pause()
+                        if key in bucket.pending:
+                            # a newer state is already waiting, this one doesn't have to be sent anymore
+                            job.future.set_result(None)
+                        else:
+                            bucket.pending[key] = job
+                            bucket.pending.move_to_end(key, last=False)
+                        continue
+                    LOG.error("OutboundQueue send failed", route=route, channel_id=channel_id, error=error)
+                    job.future.set_exception(error)
+                except Exception as error:
+                    LOG.error("OutboundQueue send failed", route=route, channel_id=channel_id, error=error)
+                    job.future.set_exception(error)
+                else:
+                    self.sent += 1
+                    if not job.future.done():
+                        job.future.set_result(result)
+        finally:
+            bucket.task = None
+            # the bucket is dropped once it has refilled, an idle channel doesn't keep it in memory
+            asyncio.get_event_loop().call_later(bucket.per, self._prune, (route, channel_id))
+
+    def _prune(self, key: tuple):
+        bucket = self.buckets.get(key)
+        if bucket is not None and bucket.task is None and not bucket.pending:
+            del self.buckets[key]
+
+    def stats(self) -> dict:
+        return {
+            "name": "outbound",
+            "queue_depth": sum(len(bucket.pending) for bucket in self.buckets.values()),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "rate_limited": self.rate_limited
+        }
+
+
+OUTBOX = OutboundQueue()
+
+
+# benchmark: a fast clicker in a channel limited to 5 edits per 5 seconds, one edit per click against the queue
+async def main(clicks: int = 30, interval: float = 0.05):
+    from types import SimpleNamespace
+
+    class FakeMessage:
+        def __init__(self):
+            self.id = 1
+            self.channel = SimpleNamespace(id=1)
+            self.calls = []
+            self.state = None
+
+        async def edit(self, content):
+            # discord makes the client wait once the channel is out of requests
+            now = time.monotonic()
+            recent = [call for call in self.calls if now - call < 5]
+            if len(recent) >= 5:
+                await asyncio.sleep(5 - (now - recent[0]))
+            self.calls.append(time.monotonic())
+            self.state = content
+
+    for name, queued in (("One edit per click", False), ("Coalescing queue", True)):
+        message = FakeMessage()
+        queue = OutboundQueue()
+        start = time.monotonic()
+        for click in range(clicks):
+            if queued:
+                future = queue.edit(message, content=click)
+            else:
+                await message.edit(content=click)
+            await asyncio.sleep(interval)
+        if queued:
+            await future
+        print(f"{name + ':':20}{len(message.calls)} edits, last state shown after "
+              f"{time.monotonic() - start:.1f}s, {queue.coalesced} coalesced")
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
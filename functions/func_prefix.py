@@ -1,76 +1,208 @@
-from discord.ext import tasks
+import asyncio
+import random
 
 import aioredis
+from pymongo.errors import PyMongoError
 
-from functions import func_database
+from functions import func_database, func_cache, func_redis, func_loader, func_metrics, func_logs
 
 import bot_settings
 
-CACHE = None
+LOG = func_logs.get_logger("prefix")
+PREFIX_SETTINGS = func_cache.CACHE_SETTINGS
+PREFIX_JITTER = PREFIX_SETTINGS.get("prefix_jitter", 0.1)
+# small in process lru in front of the per key redis entries
+LOCAL_PREFIXES = func_cache.TTLCache("prefixes", ttl=PREFIX_SETTINGS.get("prefix_ttl", 120),
+                                     maxsize=PREFIX_SETTINGS.get("prefix_maxsize", 50000), jitter=PREFIX_JITTER)
+# cache key -> task of the running lookup
+IN_FLIGHT = {}
+
+
+class PrefixIndex:
+    def __init__(self, refresh_interval: float = PREFIX_SETTINGS.get("prefix_index_refresh", 300)):
+        """First characters of every known prefix, used to skip prefix resolution for normal chat messages.
+        add only sees the prefixes set through this process, prefixes set by another shard or process are picked up
+        by the periodic rebuild, until then their messages are treated as normal chat
+        :param refresh_interval: float
+            seconds between two rebuilds from the database
+        """
+        self.characters = self._defaults()
+        self.refresh_interval = refresh_interval
+        self.ready = False
+        self.task = None
+        self.checked = 0
+        self.rejected = 0
+        func_cache.register_stats(self)
+
+    @staticmethod
+    def _defaults() -> set:
+        # "<" covers mentions, which are always a valid prefix
+        return {"<", *(prefix[0] for prefix in bot_settings.prefix if prefix)}
+
+    def add(self, prefix):
+        # add: old prefixes are not removed until the next rebuild, that only causes a lookup which would have
+        # happened anyway
+        if prefix:
+            self.characters.add(str(prefix)[0])
+
+    async def build(self, udb, sdb):
+        # build: loads the prefixes of all servers and users, the new set replaces the old one once it is complete
+        characters = self._defaults()
+        for collection in (sdb.collection, udb.collection):
+            for prefix in await collection.distinct("prefix"):
+                if prefix:
+                    characters.add(str(prefix)[0])
+        self.characters = characters
+        self.ready = True
+
+    def start(self, udb, sdb):
+        # start: starts the periodic rebuild, calling it more than once does nothing
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._refresh_loop(udb, sdb))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _refresh_loop(self, udb, sdb):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.build(udb, sdb)
+            except PyMongoError as error:
+                # the old index stays in use until the next rebuild works
+                LOG.error("PrefixIndex.refresh failed", error=error)
+
+    def may_match(self, content: str) -> bool:
+        # may_match: False if the message can't start with any prefix, always True until the index is built
+        if not self.ready:
+            return True
+        self.checked += 1
+        if content and content[0] in self.characters:
+            return True
+        self.rejected += 1
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "name": "prefix_index",
+            "characters": len(self.characters),
+            "checked": self.checked,
+            "rejected": self.rejected,
+            "reject_ratio": round(self.rejected / self.checked, 4) if self.checked else 0.0
+        }
+
+
+PREFIX_INDEX = PrefixIndex()
 
 
 class Prefix:
     def __init__(self):
-        global CACHE
         self.udb = func_database.UserDatabase()
         self.sdb = func_database.ServerDatabase()
-        self.cache = CACHE
+        self.index = PREFIX_INDEX
 
-    async def create_cache(self):
-        self.cache = await aioredis.create_redis_pool(bot_settings.redis_settings["url"], db=1)
-        await self.cache.expire("server_prefix", 360)
-        await self.cache.expire("user_prefix", 360)
-        return
+    @property
+    def cache(self) -> aioredis.Redis:
+        return func_redis.MANAGER.get("prefixes")
 
-    @tasks.loop(seconds=361)
-    async def set_expire(self):
-        await self.cache.expire("server_prefix", 360)
-        await self.cache.expire("user_prefix", 360)
+    async def build_index(self):
+        await self.index.build(self.udb, self.sdb)
+        self.index.start(self.udb, self.sdb)
 
     async def get_prefix(self, user_id, server_id) -> list:
-        # create cache
-        if not self.cache:
-            await self.create_cache()
         prefix = [*bot_settings.prefix]
-        # handle server prefix
-        server_prefix = await self.cache.hget("server_prefix", server_id, encoding="utf-8")
-        if server_prefix is None:
-            server_prefix = await self.sdb.get_server_information(server_id).distinct("prefix")
-            server_prefix = server_prefix[0] if server_prefix else 0
-            await self.cache.hset("server_prefix", server_id, server_prefix)
-        if server_prefix != 0:
+        server_prefix = await self.lookup("server", server_id)
+        if server_prefix:
             prefix.append(server_prefix)
-        # handle user prefix
-        user_prefix = await self.cache.hget("user_prefix", server_id, encoding="utf-8")
-        if user_prefix is None:
-            user_prefix = await self.udb.get_user_information_global(user_id).distinct("prefix")
-            user_prefix = user_prefix[0] if user_prefix else 0
-            await self.cache.hset("user_prefix", user_id, user_prefix)
-        if user_prefix != 0:
+        user_prefix = await self.lookup("user", user_id)
+        if user_prefix:
             prefix.append(user_prefix)
         return prefix
 
+    async def lookup(self, kind: str, id_: int) -> str:
+        # lookup: local lru, then redis, then the database. an empty string means no prefix is set
+        key = f"prefix:{kind}:{id_}"
+        prefix = LOCAL_PREFIXES.get(key)
+        if prefix is not None:
+            return prefix
+        # single flight: concurrent misses for the same id wait for the same query
+        task = IN_FLIGHT.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(kind, id_, key))
+            IN_FLIGHT[key] = task
+            task.add_done_callback(lambda _: IN_FLIGHT.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, kind: str, id_: int, key: str) -> str:
+        prefix = await self.cache.get(key, encoding="utf-8")
+        func_metrics.CACHE_REQUESTS.inc("prefix_redis", "miss" if prefix is None else "hit")
+        if prefix is None:
+            loader = func_loader.current()
+            if loader:
+                # loads the whole document, which the context of the same message reuses
+                document = await (loader.get_server(id_) if kind == "server" else loader.get_global(id_))
+                prefix = document.get("prefix") or []
+                prefix = prefix if isinstance(prefix, list) else [prefix]
+            elif kind == "server":
+                prefix = await self.sdb.get_server_information(id_).distinct("prefix")
+            else:
+                prefix = await self.udb.get_user_information_global(id_).distinct("prefix")
+            prefix = str(prefix[0]) if prefix else ""
+            await self.cache.set(key, prefix, expire=self._redis_ttl())
+        LOCAL_PREFIXES.set(key, prefix)
+        return prefix
+
+    async def _store(self, kind: str, id_: int, prefix: str):
+        key = f"prefix:{kind}:{id_}"
+        self.index.add(prefix)
+        LOCAL_PREFIXES.set(key, prefix)
+        await self.cache.set(key, prefix, expire=self._redis_ttl())
+
+    @staticmethod
+    def _redis_ttl() -> int:
+        ttl = PREFIX_SETTINGS.get("prefix_redis_ttl", 3600)
+        return int(ttl * (1 + random.uniform(-PREFIX_JITTER, PREFIX_JITTER)))
+
     async def set_prefix_user(self, user_id: int, prefix: str):
-        # create the cache
-        if not self.cache:
-            await self.create_cache()
-        # set it in the cache
-        await self.cache.hset("user_prefix", user_id, prefix)
         await self.udb.set_setting_global(
             user_id=user_id,
-            query={"$set": {"prefix": prefix}}
+            query={"$set": {"prefix": prefix}},
+            projection={"_id": True}
         )
+        # set it in the cache
+        await self._store("user", user_id, prefix)
         return
 
     async def set_prefix_server(self, server_id: int, prefix: str):
-        # create the cache
-        if not self.cache:
-            await self.create_cache()
-        # set it in the cache
-        await self.cache.hset("user_prefix", server_id, prefix)
         # set it in the database
         await self.sdb.set_setting(
             server_id=server_id,
             query={"$set": {"prefix": prefix}}
         )
+        # set it in the cache
+        await self._store("server", server_id, prefix)
         return
+
+
+# benchmark: share of messages which skip prefix resolution, the corpus is a text file with one message per line
+def main(corpus_path: str):
+    import time
+
+    index = PrefixIndex()
+    index.ready = True
+    with open(corpus_path, "r", encoding="utf-8") as corpus:
+        messages = corpus.read().splitlines()
+    start = time.perf_counter()
+    for message in messages:
+        index.may_match(message)
+    elapsed = time.perf_counter() - start
+    print(f"{index.rejected}/{index.checked} messages short-circuited "
+          f"({index.stats()['reject_ratio'] * 100:.1f}%), {elapsed / max(len(messages), 1) * 1e9:.0f} ns per check")
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1])
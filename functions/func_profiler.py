@@ -0,0 +1,194 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from functions import func_errors, func_logs
+
+LOG = func_logs.get_logger("profiler")
+# upper bounds for the owner commands, a forgotten argument shouldn't keep the process traced for an hour
+MAX_SECONDS = 120
+MIN_INTERVAL = 0.001
+# allocations of the tracing itself and of imports are noise in a diff
+MEMORY_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def short_path(path: str) -> str:
+    # short_path: paths inside the bot relative to it, libraries from site-packages on
+    for marker in ("site-packages" + os.sep, "dist-packages" + os.sep):
+        if marker in path:
+            return path.split(marker, 1)[1]
+    if path.startswith(os.getcwd()):
+        return os.path.relpath(path)
+    return path
+
+
+class SamplingProfiler:
+    def __init__(self, thread_id: int, interval: float = 0.01):
+        """Samples the stack of one thread from a background thread, the sampled thread isn't touched and the
+        result is in the collapsed stack format of flamegraph.pl and speedscope
+        :param interval: float
+            seconds between two samples, each sample holds the gil for a few microseconds
+        """
+        self.thread_id = thread_id
+        self.interval = max(interval, MIN_INTERVAL)
+        # "outer;...;inner" -> samples
+        self.stacks = Counter()
+        # code object -> frame label, the same functions show up in almost every sample
+        self.labels = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def _label(self, code) -> str:
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = f"{code.co_name} ({short_path(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def _run(self):
+        # waking up means waiting for the gil as well, samples are scheduled on deadlines so that doesn't add up
+        deadline = time.monotonic()
+        while True:
+            deadline = max(deadline + self.interval, time.monotonic())
+            if self.stopped.wait(deadline - time.monotonic()):
+                break
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit: int = 10) -> list:
+        # top_functions: (label, samples) of the innermost frames, where the time was actually spent
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return leaves.most_common(limit)
+
+
+class Profiler:
+    def __init__(self):
+        """Diagnostics for the running bot, only one of them runs at a time so they don't skew each other"""
+        self.running = None
+
+    def _begin(self, name: str):
+        if self.running is not None:
+            raise func_errors.ProfilerBusy(f"The {self.running} profile is still running, wait until it is done!")
+        self.running = name
+
+    async def profile(self, seconds: float = 10, interval: float = 0.01) -> SamplingProfiler:
+        """Samples the thread of the event loop for the given seconds
+        :return: SamplingProfiler
+            the finished profiler with the collapsed stacks
+        """
+        self._begin("cpu")
+        profiler = SamplingProfiler(threading.get_ident(), interval)
+        LOG.info("Profiler.profile started", seconds=seconds, interval=profiler.interval)
+        try:
+            profiler.start()
+            await asyncio.sleep(min(seconds, MAX_SECONDS))
+        finally:
+            profiler.stop()
+            self.running = None
+        LOG.info("Profiler.profile finished", samples=profiler.samples, stacks=len(profiler.stacks))
+        return profiler
+
+    async def memory(self, seconds: float = 30, limit: int = 10) -> tuple:
+        """Diff of two tracemalloc snapshots, tracing is only switched on for the window if it wasn't on before
+        :return: tuple
+            the tracemalloc.StatisticDiff of the top growth sites and the peak of the traced memory in bytes
+        """
+        self._begin("memory")
+        started = not tracemalloc.is_tracing()
+        try:
+            if started:
+                tracemalloc.start()
+            LOG.info("Profiler.memory started", seconds=seconds, started=started)
+            before = tracemalloc.take_snapshot()
+            await asyncio.sleep(min(seconds, MAX_SECONDS))
+            after = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            if started:
+                tracemalloc.stop()
+            self.running = None
+        # comparing walks every trace, the loop keeps serving events while it runs in the executor
+        loop = asyncio.get_event_loop()
+        diff = await loop.run_in_executor(None, lambda: after.filter_traces(MEMORY_FILTERS).compare_to(
+            before.filter_traces(MEMORY_FILTERS), "lineno"))
+        growth = [stat for stat in diff if stat.size_diff > 0][:limit]
+        LOG.info("Profiler.memory finished", peak=peak, sites=len(diff))
+        return growth, peak
+
+    @staticmethod
+    def tasks(limit: int = 20) -> tuple:
+        """Counts the pending asyncio tasks by the coroutine they run
+        :return: tuple
+            (coroutine, tasks) of the most common coroutines and the number of pending tasks
+        """
+        counts = Counter()
+        for task in asyncio.all_tasks():
+            coro = task.get_coro()
+            counts[getattr(coro, "__qualname__", type(coro).__name__)] += 1
+        return counts.most_common(limit), sum(counts.values())
+
+
+PROFILER = Profiler()
+
+
+def format_size(size: int) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:+.1f} {unit}" if unit != "B" else f"{size:+d} {unit}"
+        size /= 1024
+    return f"{size:+.1f} GiB"
+
+
+# benchmark: slowdown of a busy loop while it is sampled at different intervals
+async def main(work: int = 20_000_000):
+    def busy():
+        total = 0
+        for i in range(work):
+            total += i % 7
+        return total
+
+    start = time.perf_counter()
+    busy()
+    baseline = time.perf_counter() - start
+    print(f"{'not sampled:':16}{baseline:.2f}s")
+    for interval in (0.01, 0.001):
+        profiler = SamplingProfiler(threading.get_ident(), interval)
+        profiler.start()
+        start = time.perf_counter()
+        busy()
+        duration = time.perf_counter() - start
+        profiler.stop()
+        print(f"{f'{interval * 1000:g}ms interval:':16}{duration:.2f}s ({duration / baseline - 1:+.1%}), "
+              f"{profiler.samples} samples, top: {profiler.top_functions(1)[0][0]}")
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
@@ -0,0 +1,123 @@
+import asyncio
+
+import aioredis
+
+import bot_settings
+from functions import func_cache, func_logs
+
+LOG = func_logs.get_logger("redis")
+
+# logical database name -> redis db number, can be extended with redis_settings["databases"]
+DATABASES = {
+    "cooldowns": 0,
+    "prefixes": 1,
+    "leaderboard": 2,
+    **bot_settings.redis_settings.get("databases", {})
+}
+
+
+class RedisManager:
+    def __init__(self, address=bot_settings.redis_settings["url"], databases: dict = None,
+                 minsize: int = bot_settings.redis_settings.get("minsize", 1),
+                 maxsize: int = bot_settings.redis_settings.get("maxsize", 10),
+                 health_check_interval: float = bot_settings.redis_settings.get("health_check_interval", 30)):
+        """One pool per logical database, shared by every cog
+        :param databases: dict
+            name -> redis db number
+        :param health_check_interval: float
+            seconds between the pings of every pool
+        """
+        self.address = address
+        self.databases = databases or DATABASES
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.health_check_interval = health_check_interval
+        self.pools = {}
+        self.healthy = {}
+        self.reconnects = 0
+        self.task = None
+        func_cache.register_stats(self)
+
+    async def start(self):
+        # start: creates every pool once, called before the bot connects to discord
+        for name, db in self.databases.items():
+            if name not in self.pools:
+                self.pools[name] = await self._connect(name, db)
+                self.healthy[name] = True
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._health_check_loop())
+
+    async def _connect(self, name: str, db: int, max_delay: float = 30, attempts: int = None):
+        """Creates a pool, retries with an exponential backoff
+        :param attempts: int
+            gives up after this many failed attempts and raises the last error, retries until redis is reachable
+            if None
+        """
+        delay = 0.5
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await asyncio.wait_for(
+                    aioredis.create_redis_pool(self.address, db=db, minsize=self.minsize, maxsize=self.maxsize),
+                    timeout=10
+                )
+            except (asyncio.TimeoutError, OSError, aioredis.RedisError) as error:
+                LOG.error("RedisManager could not connect", pool=name, db=db, attempt=attempt, retry_in=delay,
+                          error=error)
+                self.reconnects += 1
+                if attempts is not None and attempt >= attempts:
+                    raise
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_delay)
+
+    async def _health_check_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            # every pool is checked on its own, one which stays down doesn't hold up the others
+            await asyncio.gather(*(self.check(name) for name in list(self.pools.keys())))
+
+    async def check(self, name: str) -> bool:
+        # check: pings the pool, a broken pool is replaced once a new one could be created
+        try:
+            await asyncio.wait_for(self.pools[name].ping(), timeout=5)
+            self.healthy[name] = True
+            return True
+        except (asyncio.TimeoutError, OSError, aioredis.RedisError) as error:
+            LOG.error("RedisManager health check failed", pool=name, error=error)
+            self.healthy[name] = False
+        try:
+            pool = await self._connect(name, self.databases[name], attempts=3)
+        except (asyncio.TimeoutError, OSError, aioredis.RedisError):
+            # the old pool stays in place, it reconnects by itself if redis comes back before the next check
+            return False
+        old, self.pools[name] = self.pools[name], pool
+        self.healthy[name] = True
+        old.close()
+        await old.wait_closed()
+        return True
+
+    def get(self, name: str) -> aioredis.Redis:
+        try:
+            return self.pools[name]
+        except KeyError:
+            raise RuntimeError(f"The redis pool {name} has not been started")
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        for pool in self.pools.values():
+            pool.close()
+            await pool.wait_closed()
+        self.pools = {}
+
+    def stats(self) -> dict:
+        stats = {"name": "redis", "reconnects": self.reconnects}
+        for name, pool in self.pools.items():
+            connection = pool.connection
+            stats[name] = f"{connection.size - connection.freesize}/{connection.maxsize} in use" \
+                          f"{'' if self.healthy.get(name) else ' (unhealthy)'}"
+        return stats
+
+
+MANAGER = RedisManager()
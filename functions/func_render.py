@@ -0,0 +1,117 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+import bot_settings
+
+RENDER_SETTINGS = getattr(bot_settings, "render_settings", {})
+WIDTH, HEIGHT = 934, 282
+COLORS = {
+    "default": {"background": (35, 39, 42), "bar": (176, 210, 231), "bar_background": (72, 75, 78),
+                "text": (255, 255, 255), "secondary": (185, 187, 190)}
+}
+
+
+def _font(size: int):
+    from PIL import ImageFont
+
+    try:
+        return ImageFont.truetype(RENDER_SETTINGS.get("font", "DejaVuSans.ttf"), size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def render_level_card(exp: int, required_exp: float, position: str, user_name: str, server_name: str,
+                      rank_card: str, next_role_name: str, profile_picture: bytes) -> bytes:
+    """Draws the rank card, runs in a worker process so it has to stay a module level function
+    :return: bytes
+        png image
+    """
+    from PIL import Image, ImageDraw
+
+    colors = COLORS.get(rank_card, COLORS["default"])
+    card = Image.new("RGBA", (WIDTH, HEIGHT), colors["background"])
+    draw = ImageDraw.Draw(card)
+    # round avatar on the left
+    if profile_picture:
+        avatar = Image.open(BytesIO(profile_picture)).convert("RGBA").resize((180, 180))
+        mask = Image.new("L", (180, 180), 0)
+        ImageDraw.Draw(mask).ellipse((0, 0, 180, 180), fill=255)
+        card.paste(avatar, (50, 51), mask)
+    # names and rank
+    draw.text((270, 50), user_name, font=_font(44), fill=colors["text"])
+    draw.text((270, 105), server_name, font=_font(26), fill=colors["secondary"])
+    draw.text((WIDTH - 50, 50), f"Rank {position}", font=_font(40), fill=colors["text"], anchor="ra")
+    # exp bar with the next role
+    progress = min(exp / required_exp, 1) if required_exp else 1
+    draw.rounded_rectangle((270, 190, WIDTH - 50, 230), radius=20, fill=colors["bar_background"])
+    if progress > 0:
+        draw.rounded_rectangle((270, 190, 270 + int((WIDTH - 320) * progress), 230), radius=20, fill=colors["bar"])
+    exp_text = f"{int(exp)} / {int(required_exp)} exp" if required_exp else f"{int(exp)} exp"
+    draw.text((270, 150), next_role_name, font=_font(26), fill=colors["secondary"])
+    draw.text((WIDTH - 50, 150), exp_text, font=_font(26), fill=colors["secondary"], anchor="ra")
+    output = BytesIO()
+    card.save(output, format="PNG")
+    return output.getvalue()
+
+
+class LocalRenderer:
+    def __init__(self, workers: int = RENDER_SETTINGS.get("workers", 2)):
+        """Renders the rank cards in a process pool, so rendering never blocks the event loop"""
+        self.workers = workers
+        self.executor = None
+
+    async def render(self, exp: int, required_exp: float, position: str, user_name: str, server_name: str,
+                     rank_card: str, next_role_name: str, profile_picture: bytes) -> bytes:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                self.executor, render_level_card, exp, required_exp, position, user_name, server_name, rank_card,
+                next_role_name, profile_picture
+            )
+        except BrokenProcessPool:
+            # a worker died, the pool can't be used anymore and the next render starts a new one
+            self.close()
+            raise
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+RENDERER = LocalRenderer()
+
+
+# benchmark: cards per second of the process pool against the grpc image service
+async def main(cards: int = 200):
+    import time
+
+    from functions import func_client_grpc, func_errors
+
+    from PIL import Image
+
+    avatar = BytesIO()
+    Image.new("RGBA", (128, 128), (200, 100, 50)).save(avatar, format="PNG")
+    avatar = avatar.getvalue()
+    start = time.perf_counter()
+    await asyncio.gather(*[RENDERER.render(i, 1000, "#12", "Pum", "Test server", "default", "Next role", avatar)
+                           for i in range(cards)])
+    local = time.perf_counter() - start
+    RENDERER.close()
+    print(f"Process pool ({RENDERER.workers} workers): {cards / local:.1f} cards/s")
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[func_client_grpc.Generator.get_grpc_image(
+            i, 1000, "#12", "Pum", "Test server", "default", func_client_grpc.Role(1, "Next role"), avatar)
+            for i in range(cards)])
+        print(f"gRPC image service: {cards / (time.perf_counter() - start):.1f} cards/s")
+    except func_errors.ImageServiceUnavailable:
+        print("gRPC image service: unavailable")
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
@@ -0,0 +1,203 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+
+import bot_settings
+from functions import func_cache, func_errors
+
+INTERACTION_SETTINGS = getattr(bot_settings, "interaction_settings", {})
+
+
+class Waiter:
+    __slots__ = ("user_id", "channel_id", "message_id", "check", "emojis", "removals", "future")
+
+    def __init__(self, user_id: int, channel_id: int, message_id: int, check, emojis, removals: bool, future):
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.check = check
+        self.emojis = emojis
+        self.removals = removals
+        self.future = future
+
+
+class InteractionRouter:
+    def __init__(self, max_sessions: int = INTERACTION_SETTINGS.get("max_sessions", 3)):
+        """Routes messages and reactions to the menus waiting for them, instead of running every
+        bot.wait_for check on every event
+        :param max_sessions: int
+            menus a user can have open at the same time
+        """
+        self.max_sessions = max_sessions
+        # (channel_id, user_id) -> waiters for messages, message_id -> waiters for reactions
+        self.by_author = {}
+        self.by_message = {}
+        # (deadline, sequence, waiter), finished waiters are skipped once they reach the top
+        self.timeouts = []
+        self.sequence = itertools.count()
+        self.timer = None
+        self.timer_deadline = None
+        self.sessions = {}
+        self.routed = 0
+        self.timed_out = 0
+        func_cache.register_stats(self)
+
+    @contextmanager
+    def session(self, user_id: int):
+        # session: counts the open menus of a user for as long as the block runs
+        if self.sessions.get(user_id, 0) >= self.max_sessions:
+            raise func_errors.TooManySessions(f"You already have {self.max_sessions} open menus, "
+                                              f"close one of them first!")
+        self.sessions[user_id] = self.sessions.get(user_id, 0) + 1
+        try:
+            yield
+        finally:
+            self.sessions[user_id] -= 1
+            if not self.sessions[user_id]:
+                del self.sessions[user_id]
+
+    async def wait(self, user_id: int, channel_id: int = None, check=None, message_id: int = None,
+                   emojis=None, removals: bool = False, timeout: float = 60) -> tuple:
+        """Waits for a message of the user in channel_id and/or a reaction of the user on message_id
+        :param check: func
+            extra check for messages, a check which raises counts as no match
+        :param emojis: list
+            the reactions which are accepted, all if None
+        :param removals: bool
+            removed reactions count as well
+        :return: tuple
+            ("message", discord.Message) or ("reaction", discord.Reaction)
+        :raises asyncio.TimeoutError:
+        """
+        loop = asyncio.get_event_loop()
+        waiter = Waiter(user_id, channel_id, message_id, check, emojis, removals, loop.create_future())
+        if channel_id is not None:
+            self.by_author.setdefault((channel_id, user_id), []).append(waiter)
+        if message_id is not None:
+            self.by_message.setdefault(message_id, []).append(waiter)
+        deadline = loop.time() + timeout
+        heapq.heappush(self.timeouts, (deadline, next(self.sequence), waiter))
+        self._schedule(loop)
+        try:
+            return await waiter.future
+        finally:
+            self._remove(waiter)
+
+    async def wait_for_message(self, channel_id: int, user_id: int, check=None, timeout: float = 60):
+        _, message = await self.wait(user_id, channel_id=channel_id, check=check, timeout=timeout)
+        return message
+
+    async def wait_for_reaction(self, message_id: int, user_id: int, emojis=None, timeout: float = 60):
+        _, reaction = await self.wait(user_id, message_id=message_id, emojis=emojis, timeout=timeout)
+        return reaction
+
+    def _remove(self, waiter: Waiter):
+        for index, key in ((self.by_author, (waiter.channel_id, waiter.user_id)),
+                           (self.by_message, waiter.message_id)):
+            waiters = index.get(key)
+            if waiters and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del index[key]
+
+    def _schedule(self, loop):
+        # _schedule: one timer for the earliest deadline, it is only moved if a waiter needs an earlier one
+        while self.timeouts and self.timeouts[0][2].future.done():
+            heapq.heappop(self.timeouts)
+        if not self.timeouts:
+            return
+        deadline = self.timeouts[0][0]
+        if self.timer is None or deadline < self.timer_deadline:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = loop.call_at(deadline, self._expire, loop)
+            self.timer_deadline = deadline
+
+    def _expire(self, loop):
+        self.timer = None
+        now = loop.time()
+        while self.timeouts and self.timeouts[0][0] <= now:
+            _, _, waiter = heapq.heappop(self.timeouts)
+            if not waiter.future.done():
+                waiter.future.set_exception(asyncio.TimeoutError())
+                self.timed_out += 1
+        self._schedule(loop)
+
+    @staticmethod
+    def _resolve(waiter: Waiter, result: tuple):
+        if not waiter.future.done():
+            waiter.future.set_result(result)
+
+    async def on_message(self, message):
+        waiters = self.by_author.get((message.channel.id, message.author.id))
+        if not waiters:
+            return
+        for waiter in list(waiters):
+            try:
+                matched = waiter.check is None or waiter.check(message)
+            except Exception:
+                matched = False
+            if matched:
+                self.routed += 1
+                self._resolve(waiter, ("message", message))
+
+    def _route_reaction(self, reaction, user, removed: bool):
+        waiters = self.by_message.get(reaction.message.id)
+        if not waiters:
+            return
+        for waiter in list(waiters):
+            if waiter.user_id != user.id or (removed and not waiter.removals):
+                continue
+            if waiter.emojis is None or reaction.emoji in waiter.emojis:
+                self.routed += 1
+                self._resolve(waiter, ("reaction", reaction))
+
+    async def on_reaction_add(self, reaction, user):
+        self._route_reaction(reaction, user, removed=False)
+
+    async def on_reaction_remove(self, reaction, user):
+        self._route_reaction(reaction, user, removed=True)
+
+    def stats(self) -> dict:
+        return {
+            "name": "interactions",
+            "sessions": sum(self.sessions.values()),
+            "waiting": len({id(waiter) for waiters in (*self.by_author.values(), *self.by_message.values())
+                            for waiter in waiters}),
+            "routed": self.routed,
+            "timed_out": self.timed_out
+        }
+
+
+ROUTER = InteractionRouter()
+
+
+# benchmark: cost of one event with many open menus, every check like bot.wait_for against the router
+async def main(sessions: int = 1000, events: int = 10000):
+    from types import SimpleNamespace
+
+    router = InteractionRouter(max_sessions=1)
+    checks = []
+    for user_id in range(sessions):
+        checks.append(lambda m, user_id=user_id: m.author.id == user_id and m.channel.id == 1)
+        asyncio.ensure_future(router.wait(user_id, channel_id=1, timeout=600))
+    await asyncio.sleep(0)
+    message = SimpleNamespace(author=SimpleNamespace(id=-1), channel=SimpleNamespace(id=1))
+    start = time.perf_counter()
+    for _ in range(events):
+        [check(message) for check in checks]
+    old = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(events):
+        await router.on_message(message)
+    new = time.perf_counter() - start
+    print(f"{sessions} open menus\n"
+          f"bot.wait_for checks: {old / events * 1e6:.1f} us per event\n"
+          f"Router:              {new / events * 1e6:.1f} us per event")
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
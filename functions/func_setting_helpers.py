@@ -3,7 +3,7 @@ from discord.ext import commands
 
 import asyncio
 
-from functions import func_database, func_msg_gen, func_prefix, func_errors
+from functions import func_database, func_msg_gen, func_prefix, func_errors, func_router
 
 import bot_settings
 
@@ -197,8 +197,8 @@ class SettingHelper:
                 f"Please input your new value for {setting.replace('_', ' ').capitalize()}\n"
                 f"{check_message.get(setting, '')}"
             )
-            task = self_object.ctx.bot.wait_for(
-                "message", timeout=60, check=checks.get(setting, False)
+            task = func_router.ROUTER.wait_for_message(
+                response.channel.id, self_object.ctx.author.id, check=checks.get(setting), timeout=60
             )
             # wait for the response
             responded = False
@@ -0,0 +1,118 @@
+import argparse
+import time
+
+import numpy as np
+
+import bot_settings
+from functions import func_economy
+
+# cards drawn per hand, a hand which is still below 17 after 12 cards is too rare to matter
+MAX_CARDS = 12
+VALUES = np.frombuffer(func_economy.VALUES, dtype=np.uint8).astype(np.int16)
+
+
+def draw(rng: np.random.Generator, games: int) -> np.ndarray:
+    # draw: values of the cards each game could draw, from an infinite shoe which is close enough to 6 decks
+    return VALUES[rng.integers(0, len(VALUES), size=(games, MAX_CARDS))]
+
+
+def play_hands(cards: np.ndarray, hard: np.ndarray, aces: np.ndarray, active: np.ndarray, stand_on: int,
+               start: int = 2) -> tuple:
+    """Draws cards for every active hand until it reaches stand_on, hands count an ace as 11 if that doesn't bust
+    :return: tuple
+        hard totals, aces and the number of cards of every hand
+    """
+    count = np.full(len(cards), start, dtype=np.int16)
+    for column in range(start, MAX_CARDS):
+        total = np.where((aces > 0) & (hard <= 11), hard + 10, hard)
+        drawing = active & (total < stand_on)
+        if not drawing.any():
+            break
+        value = cards[:, column]
+        hard = hard + np.where(drawing, value, 0)
+        aces = aces + (drawing & (value == 1))
+        count = count + drawing
+    return hard, aces, count
+
+
+def totals(hard: np.ndarray, aces: np.ndarray) -> np.ndarray:
+    return np.where((aces > 0) & (hard <= 11), hard + 10, hard)
+
+
+def simulate(games: int, rng: np.random.Generator, bet: int = 100, player_stand_on: int = 17,
+             double_down: bool = True, dealer_stand_on: int = 17, natural_only: bool = False) -> np.ndarray:
+    """Plays one batch of games with the rules of func_economy and returns the payout of every game
+    :param player_stand_on: int
+        the player hits below this total
+    :param double_down: bool
+        doubles on a starting total of 9, 10 or 11 and takes exactly one card like cmd_blackjack
+    :param natural_only: bool
+        pays 1.5x only on a two card blackjack instead of on every winning 21, a proposed rule change
+    """
+    player, dealer = draw(rng, games), draw(rng, games)
+    player_hard = player[:, 0] + player[:, 1]
+    player_aces = (player[:, 0] == 1).astype(np.int16) + (player[:, 1] == 1)
+    dealer_hard = dealer[:, 0] + dealer[:, 1]
+    dealer_aces = (dealer[:, 0] == 1).astype(np.int16) + (dealer[:, 1] == 1)
+    # the player acts first, doubling hands get exactly one more card
+    doubled = np.isin(totals(player_hard, player_aces), (9, 10, 11)) if double_down else np.zeros(games, bool)
+    player_hard = player_hard + np.where(doubled, player[:, 2], 0)
+    player_aces = player_aces + (doubled & (player[:, 2] == 1))
+    player_hard, player_aces, player_count = play_hands(player, player_hard, player_aces, ~doubled,
+                                                        player_stand_on)
+    player_count = np.where(doubled, 3, player_count)
+    player_total = totals(player_hard, player_aces)
+    player_busted = player_total > 21
+    # the dealer only draws if the player is still in the game
+    dealer_hard, dealer_aces, _ = play_hands(dealer, dealer_hard, dealer_aces, ~player_busted, dealer_stand_on)
+    dealer_total = totals(dealer_hard, dealer_aces)
+    dealer_busted = dealer_total > 21
+    # same order of checks as bj_winner_handler
+    stake = np.where(doubled, bet * 2, bet).astype(np.float64)
+    if natural_only:
+        bonus = (player_total == 21) & (player_count == 2)
+    else:
+        bonus = player_total == 21
+    payout = np.select(
+        [player_busted, dealer_busted, player_total > dealer_total, player_total == dealer_total],
+        [-stake, stake, np.where(bonus, stake * 1.5, stake), 0.0],
+        -stake
+    )
+    return np.rint(payout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monte Carlo simulation of the blackjack house edge")
+    parser.add_argument("--games", type=int, default=10_000_000)
+    parser.add_argument("--batch", type=int, default=1_000_000)
+    parser.add_argument("--bet", type=int, default=100)
+    parser.add_argument("--stand-on", type=int, default=17, help="the player hits below this total")
+    parser.add_argument("--dealer-stand-on", type=int, default=17)
+    parser.add_argument("--no-double", action="store_true")
+    parser.add_argument("--natural-only", action="store_true", help="pay 1.5x only on a two card blackjack")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    played, total, squares = 0, 0.0, 0.0
+    start = time.perf_counter()
+    while played < args.games:
+        batch = min(args.batch, args.games - played)
+        payout = simulate(batch, rng, bet=args.bet, player_stand_on=args.stand_on, double_down=not args.no_double,
+                          dealer_stand_on=args.dealer_stand_on, natural_only=args.natural_only)
+        total += payout.sum()
+        squares += np.square(payout).sum()
+        played += batch
+    duration = time.perf_counter() - start
+    mean = total / played
+    variance = squares / played - mean ** 2
+    error = 1.96 * np.sqrt(variance / played)
+    print(f"Games:           {played:,} in {duration:.1f}s ({played / duration:,.0f} games/s)\n"
+          f"EV per bet:      {mean / args.bet:+.4%} (±{error / args.bet:.4%})\n"
+          f"Variance:        {variance / args.bet ** 2:.4f} bets² per game\n"
+          f"Per 10k games:   {mean * 10000:+,.0f}{bot_settings.currency_name} created "
+          f"(±{1.96 * np.sqrt(variance * 10000):,.0f} for a single run of 10k games)")
+
+
+if __name__ == "__main__":
+    main()
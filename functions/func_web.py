@@ -1,12 +1,50 @@
+import asyncio
+
 import aiohttp
 
+from functions import func_cache
+
+WEB_SETTINGS = func_cache.CACHE_SETTINGS
+SESSION = None
+# avatar urls contain the avatar hash, so a changed avatar is a new key
+AVATARS = func_cache.ByteCache("avatars", max_bytes=WEB_SETTINGS.get("avatar_max_bytes", 32 * 1024 ** 2),
+                               directory=WEB_SETTINGS.get("avatar_directory"),
+                               max_disk_bytes=WEB_SETTINGS.get("avatar_disk_max_bytes"))
+# avatar url -> task of the running download
+IN_FLIGHT = {}
+
+
+def get_session() -> aiohttp.ClientSession:
+    # get_session: one session with a connection pool for every request
+    global SESSION
+    if SESSION is None or SESSION.closed:
+        SESSION = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=WEB_SETTINGS.get("http_connections", 20)),
+                                        timeout=aiohttp.ClientTimeout(total=10))
+    return SESSION
+
+
+async def close_session():
+    if SESSION is not None and not SESSION.closed:
+        await SESSION.close()
+
 
 async def get_profile_bytes(avatar_url: str):
-    # gets the avatar image as bytes
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url=avatar_url) as result:
-            if result.status != 200:
-                return result.raise_for_status()
-            else:
-                image = await result.read()
+    # gets the avatar image as bytes, concurrent requests for the same avatar share one download
+    image = await AVATARS.get(avatar_url)
+    if image is not None:
+        return image
+    task = IN_FLIGHT.get(avatar_url)
+    if task is None:
+        task = asyncio.ensure_future(_download(avatar_url))
+        IN_FLIGHT[avatar_url] = task
+        task.add_done_callback(lambda _: IN_FLIGHT.pop(avatar_url, None))
+    return await asyncio.shield(task)
+
+
+async def _download(avatar_url: str) -> bytes:
+    async with get_session().get(url=avatar_url) as result:
+        if result.status != 200:
+            return result.raise_for_status()
+        image = await result.read()
+    AVATARS.set(avatar_url, image)
     return image
@@ -0,0 +1,45 @@
+import asyncio
+import random
+
+import grpc
+
+from functions.grpc_functions import image_pb2_grpc, image_pb2
+
+
+class StubGenerateImages(image_pb2_grpc.GenerateImagesServicer):
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0):
+        """Offline stand in for the image service, returns the profile bytes as image
+        :param latency: float
+            seconds every call takes
+        :param failure_rate: float
+            share of calls which fail with UNAVAILABLE
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = 0
+
+    async def GenerateLevelImage(self, request, context):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            await context.abort(grpc.StatusCode.UNAVAILABLE, "stub failure")
+        return image_pb2.Image(Image=request.profile)
+
+
+async def start_server(address: str = "localhost:50051", latency: float = 0.0, failure_rate: float = 0.0):
+    server = grpc.aio.server()
+    servicer = StubGenerateImages(latency, failure_rate)
+    image_pb2_grpc.add_GenerateImagesServicer_to_server(servicer, server)
+    server.add_insecure_port(address)
+    await server.start()
+    return server, servicer
+
+
+if __name__ == "__main__":
+    async def main():
+        server, _ = await start_server()
+        await server.wait_for_termination()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
@@ -8,7 +8,8 @@ import traceback
 import asyncio
 
 import bot_settings
-from functions import func_msg_gen, func_database, func_context, func_prefix, func_logs
+from functions import func_msg_gen, func_database, func_context, func_prefix, func_logs, func_redis, func_indexes, \
+    func_loader, func_web, func_render, func_router, func_metrics
 
 
 MSG_GENERATOR = func_msg_gen.MessageGenerator()
@@ -23,17 +24,49 @@ class FullBot(commands.Bot):
     def __init__(self, command_prefix, **options):
         super().__init__(command_prefix, **options)
         self.logger = Logger.logging
+        # command latency for the metrics endpoint
+        self.before_invoke(func_metrics.before_invoke)
+        self.after_invoke(func_metrics.after_invoke)
 
     async def get_context(self, message, *, cls=func_context.FullContext):
-        return await super().get_context(message, cls=cls)
+        # one loader per message, used by the prefix lookup and the context
+        token = func_loader.CURRENT.set(func_loader.RequestLoader())
+        try:
+            return await super().get_context(message, cls=cls)
+        finally:
+            func_loader.CURRENT.reset(token)
+
+    async def start(self, *args, **kwargs):
+        # the redis pools and database indexes are created once before any event can reach the cogs
+        await func_redis.MANAGER.start()
+        await func_indexes.ensure_indexes()
+        await func_metrics.SERVER.start()
+        await super().start(*args, **kwargs)
+
+    async def close(self):
+        await super().close()
+        # the buffered exp and income increments are written once the gateway is closed and no message can add more
+        await UserDB.close()
+        Prefix.index.stop()
+        await func_redis.MANAGER.close()
+        await func_web.close_session()
+        func_render.RENDERER.close()
+        await func_metrics.SERVER.close()
 
 
 async def get_prefix(bot, message):
+    # most messages are normal chat, those can't match a prefix so the lookup is skipped
+    if not Prefix.index.may_match(message.content):
+        return commands.when_mentioned_or(*bot_settings.prefix)(bot, message)
     # gets the bot prefix
     prefix = await Prefix.get_prefix(message.author.id, message.guild.id)
     return commands.when_mentioned_or(*prefix)(bot, message)
 
 bot = FullBot(command_prefix=get_prefix, description="", case_insensitive=True)
+# menus wait on the router instead of bot.wait_for, it gets the events through these listeners
+for listener in (func_router.ROUTER.on_message, func_router.ROUTER.on_reaction_add,
+                 func_router.ROUTER.on_reaction_remove):
+    bot.add_listener(listener)
 
 
 def error_handler(error):
@@ -81,6 +114,9 @@ async def on_ready():
         f"\nLogged in as: {bot.user} - {bot.user.id}\nLatency: {round(bot.latency *1000)} ms\n"
         f"Connected to {len(bot.guilds)} guilds\nVersion: {discord.__version__}\n"
     )
+    # index the first characters of all prefixes
+    if not Prefix.index.ready:
+        await Prefix.build_index()
     # commands
     bot_extensions = bot.extensions
     count_extensions = len(bot_extensions)
@@ -112,7 +148,9 @@ async def on_ready():
 
 loop = asyncio.get_event_loop()
 
-bot.run(bot_settings.token, bot=True, reconnect=True)
+# the guard keeps the rank card worker processes from starting the bot again when they import this file
+if __name__ == "__main__":
+    bot.run(bot_settings.token, bot=True, reconnect=True)
 
 
 def get_bot():
@@ -6,7 +6,7 @@ import datetime
 import random
 import typing
 
-from functions import func_msg_gen, func_economy, func_database
+from functions import func_msg_gen, func_economy, func_database, func_router
 
 import bot_settings
 
@@ -32,8 +32,8 @@ class EconomyCommands(commands.Cog, name="Economy Commands"):
     async def cmd_balance(self, ctx, user: discord.Member = None):
         """Check another users balance."""
         user = user or ctx.author
-        information = await self.udb.get_user_information(user.id, ctx.guild.id).to_list(length=1)
-        balance = information[0].get('balance', 0) if information else 0
+        # the income of the last messages may still be in the write buffer
+        balance = await self.udb.get_buffered_amount(user.id, ctx.guild.id, "balance")
         embed = discord.Embed(
             title=f"{user.display_name}'s balance:",
             description=f"> {balance}{self.cur}"
@@ -67,21 +67,21 @@ class EconomyCommands(commands.Cog, name="Economy Commands"):
     @commands.guild_only()
     async def cmd_blackjack(self, ctx, bet_: func_economy.LocalBalance):
         """Play blackjack with this command."""
-        hand = {'bot': [], 'human': []}
-        suits = ['c', 'h', 'd', 's']
-        deck = []
+        with func_router.ROUTER.session(ctx.author.id):
+            return await self.play_blackjack(ctx, bet_)
+
+    async def play_blackjack(self, ctx, bet_: tuple):
+        hand = {'bot': func_economy.Hand(), 'human': func_economy.Hand()}
         bet = bet_[0]
         balance = bet_[1]
-        for suit in suits:
-            for rank in range(1, 14):
-                deck.append(func_economy.Card(rank, suit))
+        shoe = func_economy.get_shoe(ctx.guild.id)
+        shoe.prepare()
         # give out the cards
-        random.shuffle(deck)
-        hand['human'].append(deck.pop(0))
-        hand['bot'].append(deck.pop(0))
-
-        hand['human'].append(deck.pop(0))
-        hand['bot'].append(deck.pop(0))
+        for _ in range(2):
+            hand['human'].add(shoe.draw())
+            hand['bot'].add(shoe.draw())
+        upcard = func_economy.Hand()
+        upcard.add(hand['bot'].cards[0])
         # create the embed
         start_embed = self.bj_embed.copy()
         start_embed.add_field(
@@ -90,7 +90,7 @@ class EconomyCommands(commands.Cog, name="Economy Commands"):
         )
         start_embed.add_field(
             name="Bot",
-            value=func_economy.bj_field_generator("bot", {"bot": [hand['bot'][0]]})
+            value=func_economy.bj_field_generator("bot", {"bot": upcard})
         )
         msg = await self.msg.message_sender(ctx, embed=start_embed)
         for i in self.bj_reactions.keys():
@@ -103,30 +103,27 @@ class EconomyCommands(commands.Cog, name="Economy Commands"):
         while playing:
             # wait for reactions (15 sec timeout)
             try:
-                reaction, user = await self.bot.wait_for("reaction_add",
-                                                         check=lambda reaction_, user_:
-                                                         user_ == ctx.author
-                                                         and reaction_.emoji in self.bj_reactions.keys(),
-                                                         timeout=20.0)
+                reaction = await func_router.ROUTER.wait_for_reaction(msg.id, ctx.author.id,
+                                                                      emojis=self.bj_reactions.keys(), timeout=20.0)
             except asyncio.TimeoutError:
                 await self.udb.edit_money(ctx.author.id, ctx.guild.id, -bet)
                 return await self.msg.error_msg(ctx, "You only have 20 seconds to react."
                                                      "The money has been deducted from your balance.")
             # blackjack reaction handler
             if self.bj_reactions[reaction.emoji] == "hit":
-                hand['human'].append(deck.pop(0))
-                if func_economy.bj_hand_counter(hand['human']) > 21:
+                hand['human'].add(shoe.draw())
+                if hand['human'].total > 21:
                     player_busted = True
                     playing = False
                 else:
-                    await msg.remove_reaction(emoji=reaction.emoji, member=ctx.author)
-                    await msg.edit(embed=self.blackjack_msg_updater(msg, hand))
+                    self.msg.remove_reaction(msg, reaction.emoji, ctx.author)
+                    self.msg.edit(msg, embed=self.blackjack_msg_updater(msg, hand))
             elif self.bj_reactions[reaction.emoji] == "stand":
                 playing = False
             elif self.bj_reactions[reaction.emoji] == "double down":
-                if func_economy.bj_hand_counter(hand['human']) in [11, 10, 9] and \
+                if hand['human'].total in [11, 10, 9] and \
                         bet * 2 < balance:
-                    hand['human'].append(deck.pop(0))
+                    hand['human'].add(shoe.draw())
                     bet *= 2
                     playing = False
             else:
@@ -135,7 +132,7 @@ class EconomyCommands(commands.Cog, name="Economy Commands"):
         bot_busted = False
         if not player_busted:
             # generates the bots hand
-            hand, deck, bot_busted = func_economy.bj_handle_bot_cards(hand, deck)
+            hand, shoe, bot_busted = func_economy.bj_handle_bot_cards(hand, shoe)
         # handler for winner
         text, win, bet_edited = func_economy.bj_winner_handler(hand, player_busted, bot_busted, bet)
         # sends the embeds and changes the currency
@@ -143,7 +140,7 @@ class EconomyCommands(commands.Cog, name="Economy Commands"):
         embed.description = text.format(bet_edited)
         embed.colour = discord.Color.green() if win else discord.Color.red()
         await self.udb.edit_money(ctx.author.id, ctx.guild.id, bet_edited)
-        return await msg.edit(embed=embed, content=msg.content)
+        return await self.msg.edit(msg, embed=embed, content=msg.content)
 
     @commands.command(name="claim", aliases=["work"])
     @commands.guild_only()
@@ -248,10 +245,11 @@ class EconomyCommands(commands.Cog, name="Economy Commands"):
                         f"Reply with `{confirmation_num}` to confirm the transfer or `exit` to cancel the transfer!"
         )
         confirmation_msg = await self.msg.message_sender(ctx, confirm_embed, discord.Color.green())
-        confirm_result = await self.bot.wait_for(
-            "message", timeout=60, check=lambda m: (m.content == confirmation_num or m.content.lower() == "exit")
-                                                   and m.author == ctx.author
-        )
+        with func_router.ROUTER.session(ctx.author.id):
+            confirm_result = await func_router.ROUTER.wait_for_message(
+                ctx.channel.id, ctx.author.id, timeout=60,
+                check=lambda m: m.content == confirmation_num or m.content.lower() == "exit"
+            )
         if confirm_result.content.lower() == "exit":
             await confirmation_msg.delete()
             return await self.msg.message_sender(ctx, discord.Embed(title="Successfully cancelled the trade!"))
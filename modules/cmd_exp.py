@@ -3,7 +3,8 @@ from discord.ext import commands
 
 from io import BytesIO
 
-from functions import func_database, func_msg_gen, func_client_grpc, func_web, func_exp
+from functions import func_database, func_msg_gen, func_client_grpc, func_web, func_exp, func_leaderboard, \
+    func_errors
 
 
 class ExpCommands(commands.Cog, name="Exp Commands"):
@@ -13,6 +14,7 @@ class ExpCommands(commands.Cog, name="Exp Commands"):
         self.udb = func_database.UserDatabase()
         self.msg = func_msg_gen.MessageGenerator()
         self.client_grpc = func_client_grpc.Generator()
+        self.mirror = func_leaderboard.MIRROR
 
     @commands.cooldown(1, 30, commands.BucketType.user)
     @commands.group(name="exp", aliases=["rank", "level"], invoke_without_command=True)
@@ -30,10 +32,9 @@ class ExpCommands(commands.Cog, name="Exp Commands"):
         exp_enabled = server_settings.get("exp_enabled", False)
         if exp_enabled:
             # gets the leaderboard ranking for the user
-            exp = await self.udb.get_user_information(user.id, ctx.guild.id).distinct("exp_amount")
-            users = await self.udb.user_sort_exp(ctx.guild.id, "exp_amount", user_amount=exp[0] if exp else 0)
+            exp = await self.get_exp(ctx.guild.id, user.id)
             position = "/"
-            position += self.get_position(users, user)
+            position += str(await self.get_rank(ctx.guild.id, user.id, exp)) if exp is not None else "Not found"
         else:
             return await self.msg.error_msg(
                 ctx=ctx,
@@ -41,16 +42,12 @@ class ExpCommands(commands.Cog, name="Exp Commands"):
                     f"You can enable it with `{ctx.prefix}sset exp`."
             )
         # sends the exp message
-        exp = exp[0] if exp else 0
+        exp = exp or 0
         # downloads the profile picture and returns the bytes
         avatar_img = await func_web.get_profile_bytes(str(user.avatar_url_as(format="png", size=128)))
-        # get the exp roles
+        # get the exp roles and filter them with the servers level role index
         exp_roles = server_settings.get("exp_level_roles", [])
-        # format the exp roles dict
-        exp_roles = [{"role": item["role_id"], "requirement": item["value"]} for item in exp_roles] \
-            if exp_roles else [{}] if exp_roles else exp_roles
-        # filter exp roles
-        exp_roles = func_exp.sort_roles(exp_roles, exp)
+        exp_roles = func_exp.sort_roles(exp_roles, exp, server_id=ctx.guild.id)
         # create the Role object and set the requirement
         next_role = exp_roles[1]
         if len(next_role) == 0:
@@ -74,8 +71,17 @@ class ExpCommands(commands.Cog, name="Exp Commands"):
                     role_name="Deleted role"
                 )
         # grpc call to the Level image generator
-        img = await self.client_grpc.get_level_image(exp, requirement, f"#{position}", user.name, ctx.guild.name,
-                                                     "default", next_role, avatar_img)
+        try:
+            img = await self.client_grpc.get_level_image(exp, requirement, f"#{position}", user.name, ctx.guild.name,
+                                                         "default", next_role, avatar_img)
+        except func_errors.ImageServiceUnavailable:
+            # text fallback while the image service is down
+            embed = discord.Embed(
+                title=f"{user}'s EXP",
+                description=f"Rank: `#{position}`\nExp: `{exp}`"
+                            + (f"/`{requirement}`\nNext role: {next_role.role_name}" if requirement else "")
+            )
+            return await self.msg.message_sender(ctx, embed=embed)
         # create a file like object and send the message
         fp = BytesIO(img)
         level_img = discord.File(fp=fp, filename="level_img.png")
@@ -106,9 +112,15 @@ class ExpCommands(commands.Cog, name="Exp Commands"):
             result = await self.udb.set_setting_local(
                 user_id=user.id,
                 server_id=ctx.guild.id,
-                query={"$inc": {"exp_amount": amount if action == "add" else -amount}}
+                query={"$inc": {"exp_amount": amount if action == "add" else -amount}},
+                projection={"_id": False, "exp_amount": True}
             )
             cur_exp = result.get("exp_amount", 0)
+            # keeps the running total of the exp write buffer in sync with the direct write
+            self.udb.increment_buffer.set_total(user.id, ctx.guild.id, "exp_amount", cur_exp)
+            if self.mirror.enabled:
+                total = await self.udb.get_buffered_amount(user.id, ctx.guild.id, "exp_amount")
+                await self.mirror.set(ctx.guild.id, user.id, total)
             embed = discord.Embed(
                 title="Score successfully edited!",
                 description=f"The user {user.mention}({user}) has {cur_exp} exp now!"
@@ -127,14 +139,23 @@ class ExpCommands(commands.Cog, name="Exp Commands"):
     @commands.command(name="leaderboard", aliases=["lb", "top"])
     async def cmd_leaderboard(self, ctx, offset=0):
         """Check the servers exp leaderboard."""
-        # get all users and then filter out by the offset
-        users = await self.udb.user_sort_exp_leaderboard(ctx.guild.id, "exp_amount")
-        filtered_users = users[offset:][:10]
+        # only the requested page is loaded, the rank of the author is counted on the index
+        offset = max(offset, 0)
+        filtered_users = []
+        if self.mirror.enabled:
+            filtered_users = await self.mirror.page(ctx.guild.id, offset=offset, limit=10)
+        if not filtered_users:
+            filtered_users = await self.udb.user_sort_exp_leaderboard(ctx.guild.id, "exp_amount", offset=offset,
+                                                                      limit=10)
         embed = discord.Embed(
             title="Leaderboard",
             description=f"All time rankings for {ctx.guild.name}"
         )
-        user_position = self.get_position(users, ctx.author)
+        exp = await self.get_exp(ctx.guild.id, ctx.author.id)
+        if exp is not None:
+            user_position = await self.get_rank(ctx.guild.id, ctx.author.id, exp)
+        else:
+            user_position = "Not found"
         embed.add_field(
             name="💬 Your rank",
             value=f"You are rank `#{user_position}`!"
@@ -142,20 +163,27 @@ class ExpCommands(commands.Cog, name="Exp Commands"):
         # using mention is more API friendly and allows for no cooldown but there might be better ways to get the user
         embed.add_field(
             name="Leaderboard",
-            value="\n".join([f"#{filtered_users.index(i)+1} <@{i.get('user_id', False) or 'Not found'}> - "
-                             f"{i.get('exp_amount', 0)} exp" for i in filtered_users]),
+            value="\n".join([f"#{offset + position} <@{i.get('user_id', False) or 'Not found'}> - "
+                             f"{i.get('exp_amount', 0)} exp" for position, i in enumerate(filtered_users, 1)]),
             inline=False
         )
         await self.msg.message_sender(ctx, embed)
 
-    @staticmethod
-    def get_position(users, user) -> str:
-        position = "Not found"
-        for i in users:
-            if i.get("user_id", 0) == user.id:
-                position = users.index(i) + 1
-                break
-        return str(position)
+    async def get_exp(self, server_id: int, user_id: int):
+        # get_exp: the running total including the buffered exp, like the listener uses, None if the user has none
+        information = await self.udb.get_user_information(user_id, server_id,
+                                                          projection={"_id": False, "exp_amount": True}).to_list(1)
+        if not information:
+            return None
+        return await self.udb.get_buffered_amount(user_id, server_id, "exp_amount")
+
+    async def get_rank(self, server_id: int, user_id: int, exp: int) -> int:
+        # get_rank: uses the redis mirror if it is enabled and contains the user, the database otherwise
+        if self.mirror.enabled:
+            rank = await self.mirror.rank(server_id, user_id)
+            if rank is not None:
+                return rank
+        return await self.udb.user_rank(server_id, "exp_amount", exp)
 
 
 def setup(bot):
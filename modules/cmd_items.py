@@ -5,7 +5,7 @@ import asyncio
 import json
 import re
 
-from functions import func_database, func_msg_gen, func_setting_helpers, func_items
+from functions import func_database, func_msg_gen, func_setting_helpers, func_items, func_router
 
 import bot_settings
 
@@ -28,17 +28,18 @@ class ServerItems(commands.Cog, name="Server Items"):
         else:
             item = "".join(item)
             items = await self.idb.search_shop_items(server_id=ctx.guild.id, search=item)
-        item_list = []
-        async for item in items:
-            item_list.append(item)
         user_information = await ctx.get_user_information()
         color = user_information[0].get("embed_color", bot_settings.embed_color)
-        embeds = func_items.shop_embed_generator(item_list, color, user_information[1])
-        paginator = func_msg_gen.Paginator(ctx, timeout=180, items=item_list, items_per_page=6,
+        # the shown balance includes the income which is still in the write buffer
+        local_information = {**user_information[1],
+                             "balance": await self.udb.get_buffered_amount(ctx.author.id, ctx.guild.id, "balance")}
+        source = func_msg_gen.CursorPageSource(
+            items, items_per_page=6,
+            render=lambda page_items, page: func_items.shop_page_embed(page_items, color, local_information)
+        )
+        paginator = func_msg_gen.Paginator(ctx, timeout=180, items_per_page=6, source=source,
                                            func=func_items.shop_choice_handler, close_after_func=True,
                                            func_check=lambda m: 0 < int(m.content) < 7)
-        for embed in embeds:
-            paginator.add_page(embed)
         await paginator.start_paginator(0)
 
     @commands.group(name="item", invoke_without_command=True)
@@ -56,12 +57,12 @@ class ServerItems(commands.Cog, name="Server Items"):
         else:
             found_items = items
         color = guser_information.get("embed_color", bot_settings.embed_color)
-        embeds = func_items.item_embed_generator(found_items, color)
-        paginator = func_msg_gen.Paginator(ctx, timeout=180, items=found_items, items_per_page=6,
+        source = func_msg_gen.ListPageSource(found_items, items_per_page=6,
+                                             render=lambda page_items, page: func_items.item_page_embed(page_items,
+                                                                                                        color))
+        paginator = func_msg_gen.Paginator(ctx, timeout=180, items_per_page=6, source=source,
                                            func=func_items.item_choice_handler, close_after_func=True,
                                            func_check=lambda m: 0 < int(m.content) < 7)
-        for embed in embeds:
-            paginator.add_page(embed)
         await paginator.start_paginator(0)
 
     @cmd_item.command(name="transfer")
@@ -90,20 +91,20 @@ class ServerItems(commands.Cog, name="Server Items"):
             )
         )
         try:
-            response = await ctx.bot.wait_for(
-                "message",
-                check=lambda m: m.author == ctx.author
-                                and m.channel == ctx.channel
-                                and m.content.lower() in ["confirm", "cancel"],
-                timeout=180
-            )
+            with func_router.ROUTER.session(ctx.author.id):
+                response = await func_router.ROUTER.wait_for_message(
+                    ctx.channel.id, ctx.author.id, check=lambda m: m.content.lower() in ["confirm", "cancel"],
+                    timeout=180
+                )
         except asyncio.TimeoutError:
             await msg.delete()
             return await self.msg.error_msg(ctx, "The transfer has timed out!")
         response = response.content.lower()
         if response == "confirm":
             try:
-                receiver_information = await self.udb.get_user_information(user.id, ctx.guild.id).to_list(length=1)
+                receiver_information = await self.udb.get_user_information(
+                    user.id, ctx.guild.id, projection={"_id": False, "items": True}
+                ).to_list(length=1)
                 receiver_information = receiver_information[0]
                 receiver_item = func_items.find_item_from_id(receiver_information.get("items", []),
                                                              found_item["item_id"])
@@ -239,9 +240,8 @@ class ServerItems(commands.Cog, name="Server Items"):
             color=bot_settings.embed_color
         ))
         try:
-            response = await self.bot.wait_for(
-                "message", check=lambda m: ctx.author.id == m.author.id and m.channel.id == ctx.channel.id, timeout=60
-            )
+            with func_router.ROUTER.session(ctx.author.id):
+                response = await func_router.ROUTER.wait_for_message(ctx.channel.id, ctx.author.id, timeout=60)
         except asyncio.TimeoutError:
             await msg.delete()
             await self.msg.error_msg(
@@ -263,16 +263,19 @@ class ServerItems(commands.Cog, name="Server Items"):
             description=f"Use the `{ctx.prefix}item edit` command to edit items.",
             color=bot_settings.embed_color
         )
-        paginator = func_msg_gen.Paginator(ctx, None, 180, None, items_per_page=1)
-        embeds = []
-        async for item in items:
+
+        def render(page_items: list, page: int) -> discord.Embed:
+            # the json of an item is only built once its page is shown
             embed = base_embed.copy()
-            embed.add_field(
-                name=f"Item settings for " + item.get("name", "Name"),
-                value=f"```json\n{json.dumps(item, indent=4)}\n```"
-            )
-            embeds.append(embed)
-        paginator.add_pages(embeds)
+            for item in page_items:
+                embed.add_field(
+                    name=f"Item settings for " + item.get("name", "Name"),
+                    value=f"```json\n{json.dumps(item, indent=4)}\n```"
+                )
+            return embed
+
+        source = func_msg_gen.CursorPageSource(items, items_per_page=1, render=render)
+        paginator = func_msg_gen.Paginator(ctx, None, 180, None, items_per_page=1, source=source)
         await paginator.start_paginator()
 
     @cmd_item.command(name="delete")
@@ -1,28 +1,28 @@
 from discord.ext import commands
 from discord import utils, Object, errors
 
-import aioredis
 import logging
 from logging.handlers import RotatingFileHandler
+from typing import Optional
 
-from functions import func_msg_gen, func_database, func_errors
+from functions import func_msg_gen, func_database, func_errors, func_cooldowns, func_exp, func_leaderboard, \
+    func_logs, func_metrics
 
 import bot_settings
 
 __name__ = "cmd_listeners"
+LOG = func_logs.get_logger("listeners")
 
 
 class ListenerTest(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.msg_generator = func_msg_gen.MessageGenerator()
-        self.cache = None
+        # redis or the in process timer wheel, depending on the cooldown settings
+        self.cooldowns = func_cooldowns.create_backend()
         self.sdb = func_database.ServerDatabase()
         self.udb = func_database.UserDatabase()
-
-    async def create_cache(self):
-        self.cache = await aioredis.create_redis_pool(bot_settings.redis_settings["url"], db=0)
-        return
+        self.udb.increment_buffer.start()
 
     @commands.Cog.listener("on_command_error")
     async def error_handler(self, ctx, error):
@@ -44,6 +44,8 @@ class ListenerTest(commands.Cog):
             msg = str(error)
         elif isinstance(error, (func_errors.EconomyError, func_errors.WrongDateFormat, func_errors.DuplicateItem)):
             msg = str(error)
+        elif isinstance(error_, (func_errors.TooManySessions, func_errors.ProfilerBusy)):
+            msg = str(error_)
         elif isinstance(error, func_errors.TooManyItems):
             msg = str(error) + f"\nIf you want to add more items, remove another item or " \
                                f"consider donate here: {bot_settings.subscription_website}"
@@ -53,49 +55,61 @@ class ListenerTest(commands.Cog):
         await self.msg_generator.error_msg(ctx, msg)
 
     @commands.Cog.listener("on_message")
+    @func_metrics.ON_MESSAGE.time()
     async def on_message_handlers(self, message):
-        # return if user is a bot
-        if message.author.bot:
+        # return if user is a bot or the message was not sent in a server
+        if message.author.bot or message.guild is None:
+            return
+        # server settings are cached in process, so this only hits the database on a cache miss
+        server_information = await self.sdb.get_server_settings(message.guild.id)
+        user_roles = [i.id for i in message.author.roles]
+        cooldowns = {
+            "exp": self.reward_cooldown(server_information, "exp", bot_settings.default_exp, user_roles),
+            "income": self.reward_cooldown(server_information, "income", bot_settings.default_income, user_roles)
+        }
+        # a cooldown of 0 grants the reward for every message without arming anything
+        due = {reward: cooldown == 0 for reward, cooldown in cooldowns.items()}
+        armed = {reward: cooldown for reward, cooldown in cooldowns.items() if cooldown}
+        if armed:
+            # checks and arms both cooldowns in one round trip
+            due.update(await self.cooldowns.acquire(message.author.id, message.guild.id, armed))
+        elif not any(due.values()):
             return
-        if not self.cache:
-            await self.create_cache()
-        # handle user exp
-        exp_ = await self.cache.get(key=f"{message.author.id} - {message.guild.id}exp")
-        if not exp_:
-            server_information = await self.sdb.get_server_information(message.guild.id).to_list(length=1)
-            server_information = server_information[0] or {}
-            if server_information.get("exp_enabled", False):
-                await self.handle_exp(message, server_information)
-        income_ = await self.cache.get(key=f"{message.author.id} - {message.guild.id}income")
-        if not income_:
-            server_information = await self.sdb.get_server_information(message.guild.id).to_list(length=1)
-            server_information = server_information[0] or {}
-            if server_information.get("income_enabled", False):
-                await self.handle_income(message, server_information)
+        LOG.debug("ListenerTest.on_message_handlers", user_id=message.author.id, server_id=message.guild.id, due=due)
+        if due["exp"]:
+            await self.handle_exp(message, server_information, user_roles)
+        if due["income"]:
+            await self.handle_income(message, server_information)
 
-    async def handle_exp(self, message, server_information):
+    @staticmethod
+    def reward_cooldown(server_information: dict, reward: str, defaults: dict, user_roles: list) -> Optional[int]:
+        # reward_cooldown: returns the cooldown of the reward or None if it is disabled or the user is blacklisted
+        if not server_information.get(f"{reward}_enabled", False):
+            return None
+        roles_blacklisted = server_information.get(f"{reward}_blacklist_roles",
+                                                   defaults[f"{reward}_blacklist_roles"]) or []
+        if [i for i in roles_blacklisted if i["role_id"] in user_roles]:
+            return None
+        return server_information.get(f"{reward}_cooldown", defaults[f"{reward}_cooldown"])
+
+    async def handle_exp(self, message, server_information, user_roles):
         # TODO: multiplier for certain roles
-        # get the required information and set exp
+        # get the required information and set exp, the cooldown is already armed
         exp_amount = server_information.get("exp_amount", bot_settings.default_exp["exp_amount"])
-        cooldown = server_information.get("exp_cooldown", bot_settings.default_exp["exp_cooldown"])
         roles = server_information.get("exp_level_roles", bot_settings.default_exp["exp_level_roles"])
-        roles_blacklisted = server_information.get("exp_blacklist_roles",
-                                                   bot_settings.default_exp["exp_blacklist_roles"])
-        user_roles = [i.id for i in message.author.roles]
-        if [i for i in roles_blacklisted if i["role_id"] in user_roles]:
-            return
-        await self.cache.set(f"{message.author.id} - {message.guild.id}exp", 1, expire=cooldown)
-        result = await self.udb.set_setting_local(
-            user_id=message.author.id,
-            server_id=message.guild.id,
-            query={"$inc": {"exp_amount": exp_amount}}
-        )
-        cur_exp = result.get("exp_amount", 0)
+        # the increment is written with the next bulk flush, the running total already includes it
+        self.udb.buffer_increment(message.author.id, message.guild.id, {"exp_amount": exp_amount})
+        cur_exp = await self.udb.get_buffered_amount(message.author.id, message.guild.id, "exp_amount")
+        if func_leaderboard.MIRROR.enabled:
+            await func_leaderboard.MIRROR.set(message.guild.id, message.author.id, cur_exp)
         if roles:
-            # filters out all roles which the user already has, and which they should get
-            roles = [i for i in roles if i["value"] <= cur_exp and i["role_id"] not in user_roles]
+            # only the roles whose requirement was passed with this award, which the user does not have yet
+            index = func_exp.get_index(message.guild.id, roles)
+            roles = [i for i in index.crossed(cur_exp - exp_amount, cur_exp) if i not in user_roles]
+            if not roles:
+                return
             # creates a object for every role with the attribute id to use the edit function with it
-            new_roles = utils._unique(Object(id=r["role_id"]) for r in roles)
+            new_roles = utils._unique(Object(id=r) for r in roles)
             try:
                 await message.author.add_roles(*new_roles, reason="Leveled roles")
             except errors.Forbidden:
@@ -108,27 +122,15 @@ class ListenerTest(commands.Cog):
                 return
 
     async def handle_income(self, message, server_information):
-        # get the required information and set balance
+        # get the required information and set balance, the cooldown is already armed
         income_amount = server_information.get("income_amount", bot_settings.default_income["income_amount"])
-        cooldown = server_information.get("income_cooldown", bot_settings.default_income["income_cooldown"])
-        roles_blacklisted = server_information.get("income_blacklist_roles",
-                                                   bot_settings.default_income["income_blacklist_roles"])
-
-        user_roles = [i.id for i in message.author.roles]
-        if [i for i in roles_blacklisted if i["role_id"] in user_roles]:
-            return
         # role_multiplier = server_information.get("income_multiplier_roles",
         #                                          bot_settings.default_income["income_multiplier_roles"])
         # multiplier = 1
         # for role in [i for i in role_multiplier]:
         #     if role["role_id"] in user_roles:
         #         multiplier = role["value"]
-        await self.cache.set(f"{message.author.id} - {message.guild.id}income", 1, expire=cooldown)
-        await self.udb.set_setting_local(
-            user_id=message.author.id,
-            server_id=message.guild.id,
-            query={"$inc": {"balance": income_amount}}
-        )
+        self.udb.buffer_increment(message.author.id, message.guild.id, {"balance": income_amount})
 
 
 def setup(bot):
@@ -1,9 +1,16 @@
+import io
+import time
+
+import discord
 from discord.ext import commands
 
+from functions import func_cache, func_database, func_leaderboard, func_profiler
+
 
 class OwnerCommands(commands.Cog, name="Owner commands"):
     def __init__(self, bot):
         self.bot = bot
+        self.udb = func_database.UserDatabase()
 
     @commands.group(name="sbot", aliases=["botsettings"], invoke_without_command=True)
     @commands.is_owner()
@@ -18,6 +25,58 @@ class OwnerCommands(commands.Cog, name="Owner commands"):
             return await ctx.send(f"Something went wrong...\n{e}")
         return await ctx.send(f'Successfully reloaded {cog}!')
 
+    @cmd_bot_settings.command(name="cache")
+    async def cmd_cache_stats(self, ctx):
+        """Show the hit and miss counters of the in process caches."""
+        embed = discord.Embed(title="Cache statistics")
+        for stats in func_cache.all_stats():
+            embed.add_field(
+                name=stats.pop("name"),
+                value="\n".join(f"{key.replace('_', ' ').capitalize()}: {value}" for key, value in stats.items())
+            )
+        return await ctx.send(embed=embed)
+
+    @cmd_bot_settings.command(name="rebuildlb")
+    async def cmd_rebuild_leaderboard(self, ctx, server_id: int = None):
+        """Rebuild the redis leaderboard mirror of a server from the database."""
+        server_id = server_id or ctx.guild.id
+        if server_id in func_leaderboard.MIRROR.rebuilding:
+            return await ctx.send(f"The leaderboard of {server_id} is already being rebuilt!")
+        count = await func_leaderboard.MIRROR.rebuild(server_id, self.udb)
+        return await ctx.send(f"Successfully rebuilt the leaderboard of {server_id} with {count} members!")
+
+    @cmd_bot_settings.command(name="profile")
+    async def cmd_profile(self, ctx, seconds: float = 10, interval_ms: float = 10):
+        """Sample the event loop and send the stacks as a collapsed stack file for flamegraph.pl or speedscope."""
+        await ctx.send(f"Profiling the event loop for {min(seconds, func_profiler.MAX_SECONDS):g} seconds...")
+        profiler = await func_profiler.PROFILER.profile(seconds, interval_ms / 1000)
+        samples = max(profiler.samples, 1)
+        top = "\n".join(f"{count / samples:6.1%} {label}" for label, count in profiler.top_functions(10))
+        file = discord.File(io.BytesIO(profiler.collapsed().encode()), filename=f"profile_{int(time.time())}.folded")
+        return await ctx.send(f"{profiler.samples} samples, top functions:\n```{top[:1800]}```", file=file)
+
+    @cmd_bot_settings.command(name="memory")
+    async def cmd_memory(self, ctx, seconds: float = 30, limit: int = 10):
+        """Compare two tracemalloc snapshots and show the lines whose allocations grew the most."""
+        await ctx.send(f"Tracing allocations for {min(seconds, func_profiler.MAX_SECONDS):g} seconds...")
+        growth, peak = await func_profiler.PROFILER.memory(seconds, limit)
+        lines = [f"{func_profiler.format_size(stat.size_diff):>12} {stat.count_diff:+7d} blocks "
+                 f"{func_profiler.short_path(stat.traceback[0].filename)}:{stat.traceback[0].lineno}"
+                 for stat in growth]
+        description = "```" + ("\n".join(lines) or "nothing")[:4000] + "```"
+        embed = discord.Embed(title="Allocation growth", description=description)
+        embed.set_footer(text=f"Peak traced memory: {func_profiler.format_size(peak)[1:]}")
+        return await ctx.send(embed=embed)
+
+    @cmd_bot_settings.command(name="tasks")
+    async def cmd_tasks(self, ctx, limit: int = 20):
+        """Count the pending asyncio tasks grouped by their coroutine."""
+        counts, total = func_profiler.PROFILER.tasks(limit)
+        lines = [f"{count:>6} {name}" for name, count in counts]
+        description = "```" + ("\n".join(lines) or "nothing")[:4000] + "```"
+        embed = discord.Embed(title=f"{total} pending tasks", description=description)
+        return await ctx.send(embed=embed)
+
     @cmd_bot_settings.command(name="error")
     async def cmd_raise_error(self, ctx):
         raise Exception("test")
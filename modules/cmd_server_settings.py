@@ -41,10 +41,7 @@ class ServerSettings(commands.Cog, name="Server Settings"):
         """Change the bots prefix."""
         if not new_prefix:
             prefix_ = await ctx.get_server_information()
-            try:
-                prefix_ = prefix_[0].get("prefix", None)
-            except IndexError:
-                prefix_ = None
+            prefix_ = prefix_.get("prefix", None)
             msg = f"The servers current prefix: `{prefix_}`" if prefix_ else "No prefix currently set."
         else:
             await self.prefix.set_prefix_server(ctx.guild.id, new_prefix)
@@ -69,7 +66,7 @@ class ServerSettings(commands.Cog, name="Server Settings"):
         }
         if server_information.get('exp_enabled', False):
             del server_information["exp_enabled"]
-            settings = bot_settings.default_exp
+            settings = dict(bot_settings.default_exp)
             settings.update(server_information)
             guild_roles = ctx.guild.roles
             items, embed = self.helper.setting_formatter(settings, "exp", embed, guild_roles, items,
@@ -122,7 +119,7 @@ class ServerSettings(commands.Cog, name="Server Settings"):
         }
         if server_information.get('income_enabled', False):
             del server_information["income_enabled"]
-            settings = bot_settings.default_income
+            settings = dict(bot_settings.default_income)
             settings.update(server_information)
             guild_roles = ctx.guild.roles
             items, embed = self.helper.setting_formatter(settings, "income", embed, guild_roles, items,